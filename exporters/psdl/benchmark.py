@@ -0,0 +1,135 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import sys
+import time
+import traceback
+
+from synthetic_city import generate_city, count_elements
+from json_processor import JsonProcessor
+from bin_export import BINExporter
+from prop_rules_export import PropRulesExporter
+from cinfo_aimap_export import CinfoAimapExporter
+from scene_input import StandaloneSceneInput
+from profiler import ExportProfiler
+from task_graph import TaskGraph, print_results
+from common.main_writer import MainWriter
+
+# End to end benchmark of the export on a synthetic city (or on an exported city json), runs the same stages as export.py
+# and reports the time and RSS of each stage (and with --memory the full memory profile)
+# usage: python benchmark.py <number of elements> [--seed S] [--workers W] [--output folder] [--memory] [--skip-writer]
+#        python benchmark.py --city <city json> --modules <modules path> [...]
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark of the PSDL export on a synthetic city')
+    parser.add_argument('elements', type=int, nargs='?', default=1000, help='number of elements of the city (10 to 100000)')
+    parser.add_argument('--city', default=None, help='exported city json to use instead of a synthetic city')
+    parser.add_argument('--modules', default=None, help='modules path (with DecodeExportedJson), needed with --city')
+    parser.add_argument('--seed', type=int, default=0, help='seed of the city generator')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for the building lines and meshes (default: one per core)')
+    parser.add_argument('--output-workers', type=int, default=None, help='number of processes for the outputs (default: one per core)')
+    parser.add_argument('--output', default='benchmark', help='folder for the exported files and the reports')
+    parser.add_argument('--memory', action='store_true', help='also profile the memory with tracemalloc (much slower)')
+    parser.add_argument('--skip-writer', action='store_true', help='skip the PSDL, INST, BAI and pathset writer')
+    parser.add_argument('--verbose', action='store_true', help='show the output of the exporters')
+    return parser.parse_args()
+
+def run_benchmark(args, profiler, results):
+    if args.city is not None:
+        psdl_file = os.path.join(args.output, os.path.splitext(os.path.basename(args.city))[0] + '.psdl')
+    else:
+        psdl_file = os.path.join(args.output, 'synthetic_' + str(args.elements) + '.psdl')
+    bin_file = psdl_file.replace(".psdl", ".bin")
+    data = None
+    jp = None
+
+    def get_input_counts():
+        return {key: len(data[key]) for key in ['roads', 'intersections', 'terrainPatches', 'buildingLines', 'meshInstances']}
+    def get_table_counts():
+        return jp.get_objects().get_counts()
+
+    if args.city is not None:
+        if args.modules is not None: sys.path.append(args.modules)
+        import DecodeExportedJson
+        with profiler.stage('decode json', get_input_counts):
+            data = DecodeExportedJson.DecodeExportedJson().decode_json(args.city)
+    else:
+        with profiler.stage('generate city', get_input_counts):
+            data = generate_city(args.elements, args.seed)
+    with profiler.stage('get objects', get_table_counts):
+        jp = JsonProcessor(data, False, args.workers, profiler=profiler)
+        jp.get_objects()
+
+    # the outputs, as in export.py (with the BIN too)
+    def export_scene():
+        def get_scene_counts():
+            return dict(get_table_counts(), scene_objects=len(scene_input.obj_list))
+        with profiler.stage('read scene', get_scene_counts):
+            scene_input = StandaloneSceneInput(bin_file, jp.get_objects())
+        if not args.skip_writer:
+            with profiler.stage('write psdl, inst, bai and pathset', get_scene_counts):
+                writer = MainWriter(psdl_file, scene_input, True, True, True, True, 0, False, False, False)
+                writer.write()
+
+    outputs = TaskGraph(profiler)
+    outputs.add_task('bin', lambda: BINExporter(jp, False).export_bin_file(bin_file))
+    outputs.add_task('psdl, inst, bai and pathset', export_scene)
+    outputs.add_task('prop rules', lambda: PropRulesExporter(jp, False).export_props_rules(bin_file))
+    outputs.add_task('cinfo and aimap', lambda: CinfoAimapExporter(jp, False).export_cinfo_aimap(bin_file))
+    with profiler.stage('outputs', get_table_counts):
+        results.update(outputs.run(args.output_workers))
+    return (psdl_file, count_elements(data), len(jp.get_objects()))
+
+def main():
+    args = parse_args()
+    if not os.path.exists(args.output): os.makedirs(args.output)
+    profiler = ExportProfiler(args.memory)
+    results = {}
+    start = time.perf_counter()
+    try:
+        if args.verbose:
+            psdl_file, num_elements, num_exported = run_benchmark(args, profiler, results)
+        else:
+            with contextlib.redirect_stdout(io.StringIO()):
+                psdl_file, num_elements, num_exported = run_benchmark(args, profiler, results)
+    except Exception:
+        traceback.print_exc()
+        return 1
+    total_time = time.perf_counter() - start
+    errors = {name: results[name].error for name in results if results[name].error is not None}
+    for name in errors:
+        print('Output "' + name + '" failed:\n' + errors[name])
+
+    city_name = args.city if args.city is not None else 'seed ' + str(args.seed)
+    print(str(num_elements) + ' elements (' + city_name + '), ' + str(num_exported) + ' exported, ' + '{:.3f}'.format(total_time) + ' s')
+    profiler.print_summary()
+    print('')
+    print_results(results)
+    profiler.write_trace(psdl_file.replace(".psdl", ".trace.json"))
+    report = {
+        'format': 1,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'city': args.city,
+        'elements': num_elements,
+        'exported_elements': num_exported,
+        'seed': args.seed if args.city is None else None,
+        'workers': args.workers,
+        'total_time': total_time,
+        'peak_rss': max([rss for (t, rss) in profiler.memory_samples], default=0),
+        'stages': profiler.get_stage_totals(),
+        'outputs': {name: results[name].duration for name in results},
+        'errors': errors
+    }
+    if args.memory:
+        profiler.print_memory_summary()
+        report['memory'] = profiler.get_memory_report()
+    report_file = psdl_file.replace(".psdl", ".benchmark.json")
+    with open(report_file, 'w') as f:
+        json.dump(report, f, indent=1)
+    print("Benchmark report written to " + report_file)
+    return 1 if len(errors) > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,58 +1,72 @@
 from utils import BinaryWriter
+from output_files import OutputFiles
 
 
 class BINExporter:
-    def __init__(self, json_processor, verbose):
+    def __init__(self, json_processor, verbose, output = None):
         self.json_processor = json_processor
         self.verbose = verbose
+        self.output = output if output is not None else OutputFiles()
 
     def export_bin_file(self, filepath):
         print("Exporting BIN file...")
-        elements = self.json_processor.get_objects()
-        def write_element(writer, element):
-            writer.write_byte(element.is_mesh)
-            writer.write_string(element.name)
-            writer.write_uint32(len(element.properties))
-            for key in element.properties:
+        table = self.json_processor.get_objects()
+
+        # the geometry is written straight from the buffers of the ElementTable (vectors in x, z, y order)
+        vertices = table.get_vertex_array()[:, [0, 2, 1]].astype('<f4')
+        normals = table.get_normal_array()[:, [0, 2, 1]].astype('<f4')
+        uvs = table.get_uv_array().astype('<f4')
+        indices = table.get_index_array()
+        if len(indices) > 0 and indices.max() > 0xFFFF:
+            raise OverflowError('too many vertices in an element, indices must fit in 16 bits')
+        indices = indices.astype('<u2')
+        transforms = table.get_transform_array()
+        transforms = transforms[:, [0, 2, 1, 7, 9, 8, 6, 3, 5, 4]].astype('<f4') # translation, scale, rotation (-w, x, z, y)
+        transforms[:, 6] *= -1
+
+        def write_element(writer, i):
+            is_mesh = table.is_mesh[i] > 0
+            writer.write_byte(is_mesh)
+            writer.write_string(table.names[i])
+            properties = table.properties[i]
+            writer.write_uint32(len(properties))
+            for key in properties:
                 writer.write_string(key)
-                writer.write_string(element.properties[key])
-            writer.write_uint32(len(element.vertices))
-            for vert in element.vertices:
-                writer.write_vec3(vert)
-            writer.write_uint32(len(element.indices))
-            if element.is_mesh:
-                for j in range(len(element.indices)):
-                    iJ = element.indices[j]
-                    writer.write_uint32(len(iJ))
-                    for i in range(len(iJ) - 1, -1, -1):
-                        writer.write_uint16(iJ[i])
-                for norm in element.normals:
-                    writer.write_vec3(norm)
-                for uv in element.uvs:
-                    writer.write_vec2(uv)
+                writer.write_string(properties[key])
+            v0 = table.vertex_starts[i]
+            writer.write_uint32(table.vertex_counts[i])
+            writer.write_raw(vertices[v0:(v0 + table.vertex_counts[i])].tobytes())
+            i0 = table.index_starts[i]
+            if is_mesh:
+                s0 = table.submesh_starts[i]
+                writer.write_uint32(table.submesh_counts[i])
+                for size in table.submesh_sizes[s0:(s0 + table.submesh_counts[i])]:
+                    writer.write_uint32(size)
+                    writer.write_raw(indices[i0:(i0 + size)][::-1].tobytes())
+                    i0 += size
+                n0 = table.normal_starts[i]
+                writer.write_raw(normals[n0:(n0 + table.normal_counts[i])].tobytes())
+                u0 = table.uv_starts[i]
+                writer.write_raw(uvs[u0:(u0 + table.uv_counts[i])].tobytes())
             else:
-                for i in range(len(element.indices) - 1, -1, -1):
-                    writer.write_uint16(element.indices[i])
-            mats = element.mat.split(',')
+                writer.write_uint32(table.index_counts[i])
+                writer.write_raw(indices[i0:(i0 + table.index_counts[i])][::-1].tobytes())
+            mats = table.mats[i].split(',')
             writer.write_uint32(len(mats))
             for mat in mats:
                 writer.write_string(mat)
-            if element.translation == [0, 0, 0] and element.rotation == [0, 0, 0, 1] and element.scale == [1, 1, 1]:
+            if table.transform_is_identity[i]:
                 writer.write_byte(0)
             else:
                 writer.write_byte(1)
-                writer.write_vec3(element.translation)
-                writer.write_vec3(element.scale)
-                writer.write_float(-element.rotation[3])
-                writer.write_float(element.rotation[0])
-                writer.write_float(element.rotation[2])
-                writer.write_float(element.rotation[1])
-                
-        writer = BinaryWriter(filepath)
+                writer.write_raw(transforms[i].tobytes())
+
+        writer = BinaryWriter(filepath, self.output)
         writer.write_raw(b'km2B')
         writer.write_string('MidtownMadness2')
-        writer.write_uint32(len(elements))
-        for element in elements:
-            write_element(writer, element)
+        writer.write_uint32(len(table))
+        for i in range(len(table)):
+            write_element(writer, i)
         writer.close()
         print("BIN file exported!")
+        self.output.print_summary("BIN")
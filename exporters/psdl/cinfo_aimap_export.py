@@ -1,22 +1,58 @@
-import shutil
 from pathlib import Path
-from utils import state_val, state_bool, state_vector, state_vector_scale, clean_city_path, create_folder_if_not_exists
+import numpy as np
+from utils import state_val, state_bool, state_vector, state_vector_scale, clean_city_path
+from spatial_index import PointGrid
+from output_files import OutputFiles
+
+DEFAULT_SNAP_RADIUS = 10.0 # distance from an intersection center within which the opponent waypoints are snapped to it
 
 
 class CinfoAimapExporter:
-    def __init__(self, json_processor, verbose):
+    def __init__(self, json_processor, verbose, output = None):
         self.json_processor = json_processor
         self.verbose = verbose
+        self.output = output if output is not None else OutputFiles()
         self.filename = None
         self.bai_warning_printed = False
         self.bai_data = None
+        self.snap_radius = DEFAULT_SNAP_RADIUS
+
+    def get_intersection_center(self, obj):
+        #obj: (ExportedCityElement elem, Intersection intersection, int block), the center of the BAI intersection element
+        vertices = obj[0].vertices if obj[0] is not None else []
+        if len(vertices) == 0:
+            vertices = state_val(state_val(obj[1]['data'], 'mesh', {}), 'vertices', [])
+        if len(vertices) == 0:
+            return None
+        return np.asarray(vertices, dtype=np.float64).reshape(-1, 3).mean(axis=0)
 
     def get_bai_data(self):
-        pass
+        # (grid of the intersection centers on the ground plane, centers), from the traffic intersections of the processor
+        if self.bai_data is None:
+            grid = PointGrid(max(self.snap_radius, 1.0))
+            centers = []
+            for obj in self.json_processor.traffic_intersections:
+                center = self.get_intersection_center(obj)
+                if center is not None:
+                    grid.add(center[0], center[2])
+                    centers.append(center)
+            self.bai_data = (grid, centers)
+        return self.bai_data
 
     def snap_to_bai(self, pos):
-        # TODO: parse BAI and snap pos to nearest intersection (if within reasonable range)
-        return pos
+        # the nearest intersection center, if within the snap radius
+        if self.snap_radius <= 0:
+            return pos
+        grid, centers = self.get_bai_data()
+        if len(centers) == 0:
+            if not self.bai_warning_printed:
+                print("no BAI intersections, the opponent waypoints are not snapped")
+                self.bai_warning_printed = True
+            return pos
+        i = grid.nearest(pos["x"], pos["z"], self.snap_radius)
+        if i is None:
+            return pos
+        return {"x": float(centers[i][0]), "y": float(centers[i][1]), "z": float(centers[i][2])}
 
     def export_opponent(self, racesubfolder, opponent, opponent_id):
         model = state_val(opponent, "carModel", None)
@@ -38,7 +74,7 @@ class CinfoAimapExporter:
                 line = ",".join([str(-pos["x"]), str(pos["y"]), str(pos["z"]), "0", "0", "0", "0", "0"])
                 lines.append(line)
         oppfilename = racesubfolder + "/" + opponent_id + ".opp"
-        oppfile = open(oppfilename, 'w', newline='')
+        oppfile = self.output.open(oppfilename, 'w', newline='')
         oppfile.writelines(line + '\n' for line in lines)
         oppfile.close()
 
@@ -77,7 +113,7 @@ class CinfoAimapExporter:
     def export_race_aimap_and_opponents(self, racesubfolder, race, race_id, is_professional):
         is_p = is_professional
         aimapfilename = racesubfolder + "/" + race_id + ".aimap" + ("_p" if is_p else "")
-        aimap = open(aimapfilename, 'w', newline='')
+        aimap = self.output.open(aimapfilename, 'w', newline='')
 
         density = str(state_val(race, "trafficDensity", 0.0))
 
@@ -131,13 +167,13 @@ class CinfoAimapExporter:
         opponents_p = self.get_race_array_in_container(race, "opponents", True)
         if opponents_p is None:
             opponents_p = opponents_a
-            shutil.copy(aimapfilename, aimapfilename + "_p")
+            self.output.copy(aimapfilename, aimapfilename + "_p")
         else:
             self.export_race_aimap_and_opponents(racesubfolder, race, race_id, True)
 
         # waypoints
         waypointsfilename = racesubfolder + "/" + race_id + "waypoints.csv"
-        waypointsfile = open(waypointsfilename, 'w', newline='')
+        waypointsfile = self.output.open(waypointsfilename, 'w', newline='')
         lines = [
             "x,y,z,a,poly count,frane rate,state changes,texture changes,msg",
         ]
@@ -208,7 +244,7 @@ class CinfoAimapExporter:
 
     def export_roam_aimap(self, racesubfolder, data):
         aimapfilename = racesubfolder + "/roam.aimap"
-        aimap = open(aimapfilename, 'w', newline='')
+        aimap = self.output.open(aimapfilename, 'w', newline='')
 
         speed_limit = str(state_val(data, "speedLimit", 0.0))
 
@@ -239,11 +275,11 @@ class CinfoAimapExporter:
         ]
         aimap.writelines(line + '\n' for line in lines)
         aimap.close()
-        shutil.copy(aimapfilename, aimapfilename + "_p")
+        self.output.copy(aimapfilename, aimapfilename + "_p")
 
     def export_city_aimap(self, filename, data):
         aimapfilename = str(Path(filename).with_suffix('.aimap'))
-        aimap = open(aimapfilename, 'w', newline='')
+        aimap = self.output.open(aimapfilename, 'w', newline='')
         speed_limit = str(state_val(data, "speedLimit", 0.0))
         drive_on_left = "1" if state_val(data, "driveOnLeft", False) else "0"
 
@@ -297,7 +333,7 @@ class CinfoAimapExporter:
         lines = [header]
         lines.extend(races)
         csvfilename = racesubfolder + "/mm" + racetype + "data.csv"
-        csvfile = open(csvfilename, 'w', newline='')
+        csvfile = self.output.open(csvfilename, 'w', newline='')
         csvfile.writelines(line + '\n' for line in lines)
         csvfile.close()
 
@@ -307,6 +343,7 @@ class CinfoAimapExporter:
             print("cityProperties not found, skipping cinfo and aimap")
             return
         p = self.json_processor.data['cityProperties']
+        self.snap_radius = state_val(p, "waypointSnapRadius", DEFAULT_SNAP_RADIUS)
         citypath = clean_city_path(filename)
         cityname = Path(filename).stem
 
@@ -324,8 +361,8 @@ class CinfoAimapExporter:
 
         # write the cinfo
         tunefolder = citypath + '_tune/'
-        create_folder_if_not_exists(tunefolder)
-        cinfo = open(tunefolder + cityname + '.cinfo', 'w', newline='')
+        self.output.create_folder(tunefolder)
+        cinfo = self.output.open(tunefolder + cityname + '.cinfo', 'w', newline='')
         cinfo_lines = [
             "LocalizedName=" + localized_name,
             "MapName=" + cityname,
@@ -344,9 +381,9 @@ class CinfoAimapExporter:
 
         # write the aimaps
         racefolder = citypath + '_race/'
-        create_folder_if_not_exists(racefolder)
+        self.output.create_folder(racefolder)
         racesubfolder = racefolder + cityname + '/'
-        create_folder_if_not_exists(racesubfolder)
+        self.output.create_folder(racesubfolder)
 
         self.export_city_aimap(filename, p)
 
@@ -371,3 +408,4 @@ class CinfoAimapExporter:
         self.export_races_csv(racesubfolder, checkpointdata, "race")
 
         print("cinfo and aimap exported!")
+        self.output.print_summary("cinfo and aimap")
@@ -0,0 +1,80 @@
+import hashlib
+import json
+import os
+import pickle
+
+
+CACHE_FORMAT = 2
+HASHED_SOURCES = ['json_processor.py', 'element_table.py', 'spatial_index.py', 'utils.py', 'element_cache.py']
+
+def get_hash(value):
+    # content hash of a picklable value (the protocol is fixed so the hashes don't change between python versions)
+    return hashlib.sha1(pickle.dumps(value, protocol=4)).hexdigest()
+
+def get_core_version():
+    # version of the core and hash of the sources generating the elements, any change invalidates the cache
+    folder = os.path.dirname(os.path.abspath(__file__))
+    version = [CACHE_FORMAT]
+    settings_file = os.path.join(folder, '..', '..', 'settings.json')
+    if os.path.isfile(settings_file):
+        with open(settings_file, 'r') as f:
+            settings = json.load(f)
+        version.append(settings.get('coreVersion'))
+        version.append(settings.get('coreFeatureVersion'))
+    sources = hashlib.sha1()
+    for name in HASHED_SOURCES:
+        with open(os.path.join(folder, name), 'rb') as f:
+            sources.update(f.read())
+    version.append(sources.hexdigest())
+    return tuple(version)
+
+class ElementCache:
+    # persistent cache of the exported elements, each entry is (dependencies, elements) and is keyed by the hash of its inputs,
+    # the dependencies are checked by the caller, as they can change without changing the inputs (e.g. block perimeters)
+    def __init__(self, path, version = None):
+        self.path = path
+        self.version = version if version is not None else get_core_version()
+        self.entries = {}
+        self.used_entries = {}
+        self.hits = 0
+        self.misses = 0
+        self.load()
+
+    def load(self):
+        if not os.path.isfile(self.path):
+            return
+        try:
+            with open(self.path, 'rb') as f:
+                version, entries = pickle.load(f)
+        except Exception:
+            print('Warning: the element cache ' + self.path + ' could not be read, all the elements will be exported again')
+            return
+        if version == self.version:
+            self.entries = entries
+
+    def get(self, key, deps_valid):
+        entry = self.entries.get(key)
+        if entry is None or not deps_valid(entry[0]):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used_entries[key] = entry
+        return entry[1]
+
+    def put(self, key, deps, elements):
+        self.used_entries[key] = (deps, elements)
+
+    def save(self):
+        # only the entries of the current export are kept
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            pickle.dump((self.version, self.used_entries), f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, self.path)
+        print('element cache: ' + str(self.hits) + ' elements reused, ' + str(self.misses) + ' exported')
+
+    def start_next_export(self):
+        # for a cache kept in memory between exports (watch mode), the next export reuses the entries of this one
+        self.entries = self.used_entries
+        self.used_entries = {}
+        self.hits = 0
+        self.misses = 0
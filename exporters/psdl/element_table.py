@@ -0,0 +1,288 @@
+import array
+import itertools
+import numpy as np
+
+
+ELEMENT_FIELDS = ['is_mesh', 'name', 'mat', 'properties', 'vertices', 'indices', 'normals', 'uvs', 'translation', 'rotation', 'scale']
+
+def make_element(*values):
+    elem = ExportedCityElement()
+    for i in range(len(ELEMENT_FIELDS)):
+        setattr(elem, ELEMENT_FIELDS[i], values[i])
+    return elem
+
+class ExportedCityElement:
+    __slots__ = ELEMENT_FIELDS
+
+    def __init__(self):
+        self.is_mesh = False
+        self.name = ''
+        self.mat = ''
+        self.properties = {}
+        self.vertices = []
+        self.indices = []
+        self.normals = []
+        self.uvs = []
+        self.translation = (0,0,0)
+        self.rotation = (0,0,0,1)
+        self.scale = (1,1,1)
+
+    def __reduce__(self):
+        # copies (and pickles) are always standalone elements, also for the views
+        return (make_element, tuple(getattr(self, name) for name in ELEMENT_FIELDS))
+
+def table_field(getter):
+    def get(self):
+        return getattr(self.table, getter)(self.index)
+    def set(self, value):
+        raise AttributeError('the elements stored in an ElementTable are read-only')
+    return property(get, set)
+
+class ExportedCityElementView(ExportedCityElement):
+    # read-only element, with its fields read from an ElementTable
+    __slots__ = ['table', 'index']
+
+    def __init__(self, table, index):
+        self.table = table
+        self.index = index
+
+    is_mesh = table_field('get_is_mesh')
+    name = table_field('get_name')
+    mat = table_field('get_mat')
+    properties = table_field('get_properties')
+    vertices = table_field('get_vertices')
+    indices = table_field('get_indices')
+    normals = table_field('get_normals')
+    uvs = table_field('get_uvs')
+    translation = table_field('get_translation')
+    rotation = table_field('get_rotation')
+    scale = table_field('get_scale')
+
+def get_float32_rows(values, width):
+    if values is None:
+        return np.zeros((0, width), dtype=np.float32)
+    rows = np.asarray(values, dtype=np.float32)
+    if rows.ndim == 2 and rows.shape[1] > width:
+        rows = rows[:, :width]
+    return rows.reshape(-1, width)
+
+def extend_rows(buffer, values, width):
+    # appends the rows to a float32 buffer, returns how many they are
+    if values is None or len(values) == 0:
+        return 0
+    if not isinstance(values, np.ndarray):
+        start = len(buffer)
+        try:
+            buffer.extend(itertools.chain.from_iterable(values))
+            if len(buffer) - start == len(values) * width:
+                return len(values)
+        except TypeError:
+            pass
+        del buffer[start:] # not a list of vectors of the right size
+    rows = get_float32_rows(values, width)
+    buffer.frombytes(rows.tobytes())
+    return len(rows)
+
+def extend_indices(buffer, values):
+    # appends the indices to a uint32 buffer, returns how many they are
+    start = len(buffer)
+    try:
+        buffer.extend(values)
+        return len(buffer) - start
+    except (TypeError, OverflowError):
+        del buffer[start:]
+    indices = get_uint32_array(values)
+    buffer.frombytes(indices.tobytes())
+    return len(indices)
+
+def get_uint32_array(values):
+    values = np.asarray(values, dtype=np.int64).reshape(-1)
+    if len(values) > 0 and (values.min() < 0 or values.max() > 0xFFFFFFFF):
+        raise OverflowError('index out of range: ' + str(values.min()) + ', ' + str(values.max()))
+    return values.astype(np.uint32)
+
+class ElementTable:
+    # exported elements, stored column by column: the geometry of all the elements is in contiguous buffers
+    # (float32 vertices, normals and uvs, uint32 indices), each element has its ranges in them and its other fields
+    # in per-element columns. ExportedCityElementView objects are only created when iterating, as views of the table.
+    def __init__(self):
+        self.vertices = array.array('f') # x, y, z for each vertex
+        self.normals = array.array('f')
+        self.uvs = array.array('f')
+        self.indices = array.array('I')
+        self.submesh_sizes = array.array('I') # number of indices of each submesh, for the mesh elements
+        self.vertex_starts = array.array('Q')
+        self.vertex_counts = array.array('I')
+        self.normal_starts = array.array('Q')
+        self.normal_counts = array.array('I')
+        self.uv_starts = array.array('Q')
+        self.uv_counts = array.array('I')
+        self.index_starts = array.array('Q')
+        self.index_counts = array.array('I')
+        self.submesh_starts = array.array('Q')
+        self.submesh_counts = array.array('I')
+        self.is_mesh = array.array('B')
+        self.transforms = array.array('f') # translation (3), rotation (4) and scale (3) for each element
+        self.transform_is_identity = array.array('B') # as checked by the BIN exporter
+        self.names = []
+        self.mats = []
+        self.properties = []
+        self.strings = {} # to keep a single copy of the repeated names, materials and properties
+
+    def get_string(self, string):
+        return self.strings.setdefault(string, string)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError('element index out of range')
+        return ExportedCityElementView(self, index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield ExportedCityElementView(self, i)
+
+    def append(self, elem):
+        self.vertex_starts.append(len(self.vertices) // 3)
+        self.vertex_counts.append(extend_rows(self.vertices, elem.vertices, 3))
+        self.normal_starts.append(len(self.normals) // 3)
+        self.normal_counts.append(extend_rows(self.normals, elem.normals, 3))
+        self.uv_starts.append(len(self.uvs) // 2)
+        self.uv_counts.append(extend_rows(self.uvs, elem.uvs, 2))
+        self.index_starts.append(len(self.indices))
+        self.submesh_starts.append(len(self.submesh_sizes))
+        if elem.is_mesh:
+            num_indices = 0
+            for sub in elem.indices:
+                size = extend_indices(self.indices, sub)
+                self.submesh_sizes.append(size)
+                num_indices += size
+            self.index_counts.append(num_indices)
+            self.submesh_counts.append(len(elem.indices))
+        else:
+            self.index_counts.append(extend_indices(self.indices, elem.indices))
+            self.submesh_counts.append(0)
+        self.is_mesh.append(1 if elem.is_mesh else 0)
+        identity = elem.translation == [0, 0, 0] and elem.rotation == [0, 0, 0, 1] and elem.scale == [1, 1, 1]
+        self.transform_is_identity.append(1 if identity else 0)
+        t = elem.translation
+        r = elem.rotation
+        s = elem.scale
+        self.transforms.extend((t[0], t[1], t[2], r[0], r[1], r[2], r[3], s[0], s[1], s[2]))
+        self.names.append(self.get_string(elem.name))
+        self.mats.append(self.get_string(elem.mat))
+        properties = elem.properties
+        self.properties.append({self.get_string(key): self.get_string(properties[key]) for key in properties})
+
+    def extend(self, elements, start = 0, end = None):
+        # adds the elements of a list, or the ones from start to end of another table
+        if not isinstance(elements, ElementTable):
+            for elem in elements:
+                self.append(elem)
+            return
+        other = elements
+        if end is None:
+            end = len(other)
+        if start >= end:
+            return
+        def extend_range(buffer, other_buffer, starts, counts, other_starts, other_counts, width):
+            # the elements of a table are contiguous in its buffers
+            b0 = other_starts[start]
+            b1 = other_starts[end - 1] + other_counts[end - 1]
+            offset = len(buffer) // width
+            starts.frombytes((np.frombuffer(other_starts, dtype=np.uint64)[start:end] - np.uint64(b0) + np.uint64(offset)).tobytes())
+            counts.extend(other_counts[start:end])
+            buffer.extend(other_buffer[(b0 * width):(b1 * width)])
+        extend_range(self.vertices, other.vertices, self.vertex_starts, self.vertex_counts, other.vertex_starts, other.vertex_counts, 3)
+        extend_range(self.normals, other.normals, self.normal_starts, self.normal_counts, other.normal_starts, other.normal_counts, 3)
+        extend_range(self.uvs, other.uvs, self.uv_starts, self.uv_counts, other.uv_starts, other.uv_counts, 2)
+        extend_range(self.indices, other.indices, self.index_starts, self.index_counts, other.index_starts, other.index_counts, 1)
+        extend_range(self.submesh_sizes, other.submesh_sizes, self.submesh_starts, self.submesh_counts, other.submesh_starts, other.submesh_counts, 1)
+        self.is_mesh.extend(other.is_mesh[start:end])
+        self.transforms.extend(other.transforms[(start * 10):(end * 10)])
+        self.transform_is_identity.extend(other.transform_is_identity[start:end])
+        self.names.extend(self.get_string(name) for name in other.names[start:end])
+        self.mats.extend(self.get_string(mat) for mat in other.mats[start:end])
+        for properties in other.properties[start:end]:
+            self.properties.append({self.get_string(key): self.get_string(properties[key]) for key in properties})
+
+    def get_counts(self):
+        return {'elements': len(self), 'vertices': len(self.vertices) // 3, 'indices': len(self.indices)}
+
+    def get_range(self, start, end):
+        table = ElementTable()
+        table.extend(self, start, end)
+        return table
+
+    def get_renamed(self, rename):
+        # copy of the table with the name and properties of each element given by rename(name, properties)
+        table = self.get_range(0, len(self))
+        for i in range(len(table)):
+            name, properties = rename(table.names[i], table.properties[i])
+            table.names[i] = table.get_string(name)
+            table.properties[i] = properties
+        return table
+
+    # whole buffers (the table must not be extended while they are in use)
+
+    def get_vertex_array(self):
+        return np.frombuffer(self.vertices, dtype=np.float32).reshape(-1, 3)
+
+    def get_normal_array(self):
+        return np.frombuffer(self.normals, dtype=np.float32).reshape(-1, 3)
+
+    def get_uv_array(self):
+        return np.frombuffer(self.uvs, dtype=np.float32).reshape(-1, 2)
+
+    def get_index_array(self):
+        return np.frombuffer(self.indices, dtype=np.uint32)
+
+    def get_transform_array(self):
+        return np.frombuffer(self.transforms, dtype=np.float32).reshape(-1, 10)
+
+    # fields of single elements (copies)
+
+    def get_is_mesh(self, index):
+        return self.is_mesh[index] > 0
+
+    def get_name(self, index):
+        return self.names[index]
+
+    def get_mat(self, index):
+        return self.mats[index]
+
+    def get_properties(self, index):
+        return self.properties[index]
+
+    def get_vertices(self, index):
+        start = self.vertex_starts[index]
+        return self.get_vertex_array()[start:(start + self.vertex_counts[index])].copy()
+
+    def get_normals(self, index):
+        start = self.normal_starts[index]
+        return self.get_normal_array()[start:(start + self.normal_counts[index])].copy()
+
+    def get_uvs(self, index):
+        start = self.uv_starts[index]
+        return self.get_uv_array()[start:(start + self.uv_counts[index])].copy()
+
+    def get_indices(self, index):
+        start = self.index_starts[index]
+        indices = self.get_index_array()[start:(start + self.index_counts[index])].copy()
+        if not self.is_mesh[index]:
+            return indices
+        sizes = self.submesh_sizes[self.submesh_starts[index]:(self.submesh_starts[index] + self.submesh_counts[index])]
+        return np.split(indices, np.cumsum(sizes)[:-1]) if len(sizes) > 0 else []
+
+    def get_translation(self, index):
+        return tuple(self.transforms[(index * 10):(index * 10 + 3)])
+
+    def get_rotation(self, index):
+        return tuple(self.transforms[(index * 10 + 3):(index * 10 + 7)])
+
+    def get_scale(self, index):
+        return tuple(self.transforms[(index * 10 + 7):(index * 10 + 10)])
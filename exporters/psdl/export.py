@@ -1,6 +1,12 @@
-import sys
+import argparse
+import json
+import multiprocessing
 import os
+import socket
+import sys
+import time
 import traceback
+from contextlib import redirect_stdout
 
 sys.path.append(sys.argv[1])
 
@@ -10,73 +16,456 @@ from bin_export import BINExporter
 from prop_rules_export import PropRulesExporter
 from cinfo_aimap_export import CinfoAimapExporter
 from scene_input import StandaloneSceneInput
+from element_cache import ElementCache, get_hash
+from profiler import ExportProfiler, NULL_PROFILER
+from task_graph import TaskGraph, TaskResult, print_results
+from output_files import OutputFiles, ArchiveOutputFiles, get_archive, get_archive_name
 from common.main_writer import MainWriter
 
+# usage: python export.py <modules path> <input json file> <output psdl file> <flags, 0 or 1>
+#        python export.py <modules path> --batch <job file> [--workers N] [--summary file]
+#        python export.py <modules path> --watch <job file> [--interval seconds] [--port N]
+
+# ids of the flags in settings.json, in the order of the arguments (the first index is 4):
+# - write prop rules
+# - write bin only (will ignore the subsequent flags if set)
+# - write psdl
+# - write inst
+# - write bai
+# - write pathset
+# - write cinfo and aimap
+# - //write pkgs (disabled, not working yet)
+# - split non coplanar roads
+# - accurate bai culling
+# - cap materials to 511
+# - verbose
+# - incremental (reuse the unchanged elements of the previous export)
+# - profile (write the timings of the export stages to a trace file and print a summary)
+# - profile memory (write the memory use of the export stages to a report file and print a summary)
+# - archive (pack the city files in an MM2 archive next to the output file, .ar)
+FLAGS = [
+    'propRules', 'bin', 'psdl', 'inst', 'bai', 'pathset', 'cinfo_aimap', 'psdl_splitNonCoplanarRoads',
+    'bai_accurateCulling', 'psdl_capMaterials', 'verbose', 'incremental', 'profile', 'profileMemory', 'archive'
+]
+SCENE_EXTENSIONS = {'psdl': '.psdl', 'inst': '.inst', 'bai': '.bai', 'pathset': '.pathset'} # files of the scene writer, by flag
+
 def parse_flag(i):
     return int(sys.argv[i]) > 0
 
-try:
-    if len(sys.argv) != 15:
-        raise Exception("Wrong number of arguments, must be 14 (modules path, input json file, output psdl file, and 12 flags), got " + str(len(sys.argv) - 1))
-    # flag order (values are 0 or 1, first index is 4):
-    # - write prop rules
-    # - write bin only (will ignore the subsequent flags if set)
-    # - write psdl
-    # - write inst
-    # - write bai
-    # - write pathset
-    # - write cinfo and aimap
-    # - //write pkgs (disabled, not working yet)
-    # - split non coplanar roads
-    # - accurate bai culling
-    # - cap materials to 511
-    # - verbose
-
-    write_prop_rules = parse_flag(4)
-    write_bin_only = parse_flag(5)
-    write_psdl = parse_flag(6)
-    write_inst = parse_flag(7)
-    write_bai = parse_flag(8)
-    write_pathset = parse_flag(9)
-    write_cinfo_aimap = parse_flag(10)
-    #write_pkgs = parse_flag(11)
-    split_non_coplanar_roads = parse_flag(11)
-    accurate_bai_culling = parse_flag(12)
-    cap_materials = parse_flag(13)
-    verbose = parse_flag(14)
-
-    psdl_file = sys.argv[3]
+def get_default_flags():
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'settings.json'), 'r') as f:
+        settings = json.load(f)
+    return {flag['id']: flag['defaultValue'] for flag in settings['flags']}
+
+# inputs of each output, among the hashes of get_data_hashes (the outputs also depend on the flags)
+OUTPUT_INPUTS = {
+    'bin': ['elements'],
+    'psdl, inst, bai and pathset': ['elements'],
+    'prop rules': ['elements'],
+    'cinfo and aimap': ['elements', 'cityProperties'] # the waypoints are snapped to the intersections
+}
+
+def get_data_hashes(data):
+    # content hash of the city elements (everything read by the processor) and of the city properties (races, cinfo and aimap)
+    return {
+        'elements': get_hash({key: data[key] for key in data if key != 'cityProperties'}),
+        'cityProperties': get_hash(data.get('cityProperties'))
+    }
+
+def export_city(input_file, psdl_file, flags, num_workers = None, state = None, data = None):
+    profiler = ExportProfiler(flags['profileMemory']) if flags['profile'] or flags['profileMemory'] else NULL_PROFILER
+    try:
+        return export_city_stages(input_file, psdl_file, flags, num_workers, state, data, profiler)
+    finally:
+        # or the memory tracing would slow down the next exports of the process (batch and watch modes)
+        profiler.stop()
+
+def export_city_stages(input_file, psdl_file, flags, num_workers, state, data, profiler):
+    # exports a city with the flags (by id), returns the TaskResult of each output (data is the decoded city, if already read),
+    # num_workers limits the processes of the export (1 to run everything in this process),
+    # state is a dict kept between the exports of the same city (watch mode): the processor, the element cache in memory
+    # and the inputs of the last outputs, the stages whose inputs didn't change are skipped,
+    # with the archive flag the outputs return their files instead of writing them, so they are written at once in the archive
+    write_prop_rules = flags['propRules']
+    write_bin_only = flags['bin']
+    write_psdl = flags['psdl']
+    write_inst = flags['inst']
+    write_bai = flags['bai']
+    write_pathset = flags['pathset']
+    write_cinfo_aimap = flags['cinfo_aimap']
+    split_non_coplanar_roads = flags['psdl_splitNonCoplanarRoads']
+    accurate_bai_culling = flags['bai_accurateCulling']
+    cap_materials = flags['psdl_capMaterials']
+    verbose = flags['verbose']
+    incremental = flags['incremental']
+    profile = flags['profile']
+    profile_memory = flags['profileMemory']
+    write_archive = flags['archive']
+
     bin_file = psdl_file.replace(".psdl", ".bin")
 
+    # elements held at the end of each stage, for the memory profile
+    def get_input_counts():
+        return {key: len(data[key]) for key in ['roads', 'intersections', 'terrainPatches', 'buildingLines', 'meshInstances']}
+    def get_table_counts():
+        return jp.get_objects().get_counts()
+
     # export BIN
-    dj = DecodeExportedJson.DecodeExportedJson()
-    data = dj.decode_json(sys.argv[2])
-    jp = JsonProcessor(data, verbose)
-    jp.get_objects()
-    bin_exp = BINExporter(jp, verbose)
-    bin_exp.export_bin_file(bin_file)
-
-    if not write_bin_only:
-        # not a bin only export
-        scene_input = StandaloneSceneInput(bin_file)
-        writer = MainWriter(
-            psdl_file, scene_input, write_psdl, write_inst, write_bai,
-            write_pathset, 0, split_non_coplanar_roads,
-            accurate_bai_culling, cap_materials
-        )
-        writer.write()
-        os.remove(bin_file)
+    with profiler.stage('decode json', get_input_counts):
+        if data is None:
+            dj = DecodeExportedJson.DecodeExportedJson()
+            data = dj.decode_json(input_file)
+    hashes = get_data_hashes(data) if state is not None else None
+    with profiler.stage('get objects', get_table_counts):
+        if state is not None and state.get('elements') == hashes['elements']:
+            # same elements as the last export, only the city properties can be different
+            jp = state['processor']
+            jp.data['cityProperties'] = data.get('cityProperties')
+            if jp.data['cityProperties'] is None:
+                del jp.data['cityProperties']
+        else:
+            if state is not None:
+                # released before the new one is built, nothing is reused if building it fails
+                state.pop('processor', None)
+                state.pop('elements', None)
+                if 'cache' not in state:
+                    state['cache'] = ElementCache(psdl_file.replace(".psdl", ".cache"))
+                cache = state['cache']
+            else:
+                cache = ElementCache(psdl_file.replace(".psdl", ".cache")) if incremental else None
+            jp = JsonProcessor(data, verbose, num_workers, cache=cache, profiler=profiler)
+            jp.get_objects()
+            if incremental:
+                cache.save()
+            if state is not None:
+                cache.start_next_export()
+                state['processor'] = jp
+                state['elements'] = hashes['elements']
 
-    if write_prop_rules:
-        prop_exp = PropRulesExporter(jp, verbose)
+    # the outputs only depend on the processor, so they are exported at the same time (each in its own process if possible)
+    def new_output():
+        return ArchiveOutputFiles() if write_archive else OutputFiles()
+
+    def export_bin():
+        # the BIN is not a file of the game, it's never in the archive
+        bin_exp = BINExporter(jp, verbose)
+        bin_exp.export_bin_file(bin_file)
+
+    def export_scene():
+        # not a bin only export, the elements are read directly from the processor (no need for the BIN file)
+        def get_scene_counts():
+            return dict(get_table_counts(), scene_objects=len(scene_input.obj_list))
+        with profiler.stage('read scene', get_scene_counts):
+            scene_input = StandaloneSceneInput(bin_file, jp.get_objects())
+        with profiler.stage('write psdl, inst, bai and pathset', get_scene_counts):
+            writer = MainWriter(
+                psdl_file, scene_input, write_psdl, write_inst, write_bai,
+                write_pathset, 0, split_non_coplanar_roads,
+                accurate_bai_culling, cap_materials
+            )
+            writer.write()
+        if write_archive:
+            # the writer can only write to files, they are read back for the archive
+            output = ArchiveOutputFiles()
+            for flag in SCENE_EXTENSIONS:
+                filename = psdl_file.replace(".psdl", SCENE_EXTENSIONS[flag])
+                if flags[flag] and os.path.isfile(filename):
+                    output.copy(filename, filename)
+            return output.files
+
+    def export_prop_rules():
+        output = new_output()
+        prop_exp = PropRulesExporter(jp, verbose, output)
         prop_exp.export_props_rules(bin_file)
+        return output.files if write_archive else None
 
-    if write_cinfo_aimap:
-        cinfo_aimap_exp = CinfoAimapExporter(jp, verbose)
+    def export_cinfo_aimap():
+        output = new_output()
+        cinfo_aimap_exp = CinfoAimapExporter(jp, verbose, output)
         cinfo_aimap_exp.export_cinfo_aimap(bin_file)
+        return output.files if write_archive else None
+
+    outputs = TaskGraph(profiler)
+    output_keys = {}
+    skipped = {}
+    def add_output(name, function):
+        if state is not None:
+            output_keys[name] = (tuple(hashes[key] for key in OUTPUT_INPUTS[name]), tuple(sorted(flags.items())))
+            if state.get('outputs', {}).get(name) == output_keys[name]:
+                skipped[name] = TaskResult(name, value=state['values'][name], skipped=True)
+                return
+        outputs.add_task(name, function)
+
+    if write_bin_only:
+        add_output('bin', export_bin)
+    else:
+        add_output('psdl, inst, bai and pathset', export_scene)
+    if write_prop_rules:
+        add_output('prop rules', export_prop_rules)
+    if write_cinfo_aimap:
+        add_output('cinfo and aimap', export_cinfo_aimap)
+    with profiler.stage('outputs', get_table_counts):
+        results = dict(skipped, **outputs.run(num_workers))
+    print_results(results)
+    if state is not None:
+        # only the outputs written successfully can be skipped by the next export
+        state['outputs'] = {name: output_keys[name] for name in results if results[name].error is None}
+        state['values'] = {name: results[name].value for name in results if results[name].error is None}
+
+    if write_archive:
+        if all(results[name].error is None for name in results):
+            city_path = psdl_file.replace(".psdl", "")
+            files = {}
+            for name in results:
+                if results[name].value is not None:
+                    for path in results[name].value:
+                        files[get_archive_name(path, city_path)] = results[name].value[path]
+            with profiler.stage('write archive'):
+                archive_file = psdl_file.replace(".psdl", ".ar")
+                archive_output = OutputFiles()
+                archive_output.write(archive_file, get_archive(files))
+                print('Archive with ' + str(len(files)) + ' files: ' + archive_output.get_summary() + ' (' + archive_file + ')')
+        else:
+            print('Archive not written, some outputs failed')
+
+    if profile:
+        profiler.write_trace(psdl_file.replace(".psdl", ".trace.json"))
+        profiler.print_summary()
+    if profile_memory:
+        profiler.write_memory_report(psdl_file.replace(".psdl", ".memory.json"))
+        profiler.print_memory_summary()
+    return results
+
+def parse_batch_args():
+    parser = argparse.ArgumentParser(prog='export.py <modules path> --batch', description='Exports the cities of a job file, without prompts')
+    parser.add_argument('jobs', help='job file')
+    parser.add_argument('--workers', type=int, default=1, help='number of cities exported at the same time (default: 1)')
+    parser.add_argument('--summary', default=None, help='json file for the results of each city')
+    return parser.parse_args(sys.argv[3:])
+
+def load_jobs(job_file):
+    # job file: {"flags": {flag id: value}, "jobs": [{"input": city json, "output": psdl file, "flags": {flag id: value}}]},
+    # the flags of a job override the ones of the file, which override the defaults in settings.json,
+    # the relative paths are relative to the job file
+    with open(job_file, 'r') as f:
+        batch = json.load(f)
+    folder = os.path.dirname(os.path.abspath(job_file))
+    defaults = get_default_flags()
+    defaults.update(batch.get('flags', {}))
+    jobs = []
+    for i, job in enumerate(batch['jobs']):
+        if 'input' not in job or 'output' not in job:
+            raise Exception('Job ' + str(i) + ' must have an input and an output')
+        flags = dict(defaults)
+        flags.update(job.get('flags', {}))
+        unknown = [flag for flag in flags if flag not in FLAGS]
+        if len(unknown) > 0:
+            raise Exception('Unknown flags in job ' + str(i) + ': ' + ', '.join(unknown))
+        jobs.append({
+            'input': os.path.join(folder, job['input']),
+            'output': os.path.join(folder, job['output']),
+            'flags': {flag: bool(flags[flag]) for flag in FLAGS}
+        })
+    return jobs
+
+def run_job(job, num_workers = None, state = None):
+    # exports the city of a job, what it prints goes to a log file next to the output, returns the result of the job
+    start = time.perf_counter()
+    log_file = job['output'].replace(".psdl", ".log")
+    error = None
+    results = {}
+    try:
+        output_folder = os.path.dirname(job['output'])
+        if output_folder != '' and not os.path.exists(output_folder):
+            os.makedirs(output_folder)
+        with open(log_file, 'w') as log, redirect_stdout(log):
+            try:
+                results = export_city(job['input'], job['output'], job['flags'], num_workers, state)
+            except Exception:
+                traceback.print_exc(file=log)
+                raise
+    except Exception:
+        error = traceback.format_exc()
+    outputs = {name: {'time': results[name].duration, 'error': results[name].error, 'unchanged': results[name].skipped} for name in results}
+    failed = error is not None or any(outputs[name]['error'] is not None for name in outputs)
+    return {
+        'input': job['input'],
+        'output': job['output'],
+        'log': log_file,
+        'status': 'failed' if failed else 'ok',
+        'time': time.perf_counter() - start,
+        'error': error,
+        'outputs': outputs
+    }
+
+def _run_pool_job(job):
+    # the pool workers are daemons, which can't start the processes of the export
+    return run_job(job, 1)
+
+def run_batch():
+    # returns the exit code: 0 if all the cities were exported, 1 if some failed, 2 if the job file is not valid
+    args = parse_batch_args()
+    try:
+        jobs = load_jobs(args.jobs)
+    except Exception:
+        traceback.print_exc()
+        return 2
+    start = time.perf_counter()
+    num_workers = max(1, min(args.workers, len(jobs)))
+    if num_workers > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+        num_workers = 1 # the workers need the modules already imported by this process
+    print('Exporting ' + str(len(jobs)) + ' cities with ' + str(num_workers) + ' workers')
+    results = []
+    if num_workers <= 1:
+        for job in jobs:
+            results.append(run_job(job))
+            print('{:<50} {:>8} {:>10.3f} s'.format(os.path.basename(job['input'])[-50:], results[-1]['status'], results[-1]['time']))
+    else:
+        sys.stdout.flush()
+        # a new process for each city, so the memory of the previous ones is released
+        with multiprocessing.get_context('fork').Pool(num_workers, maxtasksperchild=1) as pool:
+            for result in pool.imap(_run_pool_job, jobs):
+                results.append(result)
+                print('{:<50} {:>8} {:>10.3f} s'.format(os.path.basename(result['input'])[-50:], result['status'], result['time']))
+    total_time = time.perf_counter() - start
+
+    failed = [result for result in results if result['status'] != 'ok']
+    for result in failed:
+        print('')
+        print(result['input'] + ' failed (log: ' + result['log'] + ')')
+        if result['error'] is not None:
+            print(result['error'])
+        for name in result['outputs']:
+            if result['outputs'][name]['error'] is not None:
+                print('Error in ' + name + ':\n' + result['outputs'][name]['error'])
+    print('')
+    print(str(len(results) - len(failed)) + ' of ' + str(len(results)) + ' cities exported in ' + '{:.3f}'.format(total_time) + ' s')
+    if args.summary is not None:
+        summary = {
+            'format': 1,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'workers': num_workers,
+            'total_time': total_time,
+            'jobs': results
+        }
+        with open(args.summary, 'w') as f:
+            json.dump(summary, f, indent=1)
+        print('Summary written to ' + args.summary)
+    return 1 if len(failed) > 0 else 0
+
+def parse_watch_args():
+    parser = argparse.ArgumentParser(prog='export.py <modules path> --watch', description='Exports the cities of a job file again each time they change, keeping the export state in memory')
+    parser.add_argument('jobs', help='job file (as in batch mode)')
+    parser.add_argument('--interval', type=float, default=0.5, help='seconds between the checks of the city files (default: 0.5)')
+    parser.add_argument('--port', type=int, default=None, help='also take export requests on this local port')
+    return parser.parse_args(sys.argv[3:])
+
+def get_file_stamp(path):
+    try:
+        stat = os.stat(path)
+        return (stat.st_mtime_ns, stat.st_size)
+    except OSError:
+        return None
+
+def export_watched_job(job, state, start_time):
+    # exports a job of the watch mode, the latency is the time from start_time (when the city file was saved,
+    # or when the request was received) to the end of the export
+    result = run_job(job, None, state)
+    result['latency'] = time.time() - start_time
+    unchanged = [name for name in result['outputs'] if result['outputs'][name]['unchanged']]
+    line = '{} {:<40} {:>8} {:>8.3f} s'.format(time.strftime('%H:%M:%S'), os.path.basename(job['input'])[-40:], result['status'], result['time'])
+    line += ' ({:.3f} s latency)'.format(result['latency'])
+    if len(unchanged) > 0:
+        line += ', unchanged: ' + ', '.join(unchanged)
+    print(line)
+    if result['status'] != 'ok':
+        print('  see ' + result['log'])
+    sys.stdout.flush()
+    return result
+
+def handle_request(conn, jobs, states, stamps):
+    # a request is a line with the input file of a job (or nothing for all the jobs), or "quit" to stop the daemon,
+    # the result of each export is sent back as a json line, returns False to stop
+    request = conn.makefile('r').readline().strip()
+    start_time = time.time()
+    if request == 'quit':
+        conn.sendall(b'{"status": "stopped"}\n')
+        return False
+    indices = [i for i in range(len(jobs)) if request in ['', jobs[i]['input'], os.path.basename(jobs[i]['input'])]]
+    if len(indices) == 0:
+        conn.sendall((json.dumps({'status': 'failed', 'error': 'no job for ' + request}) + '\n').encode())
+    for i in indices:
+        # exported even if the file didn't change, the stages whose inputs didn't change are still skipped
+        stamps[i] = get_file_stamp(jobs[i]['input'])
+        result = export_watched_job(jobs[i], states[i], start_time)
+        conn.sendall((json.dumps(result) + '\n').encode())
+    return True
+
+def run_watch():
+    # runs until interrupted (or stopped by a request), returns the exit code
+    args = parse_watch_args()
+    try:
+        jobs = load_jobs(args.jobs)
+    except Exception:
+        traceback.print_exc()
+        return 2
+    states = [{} for job in jobs]
+    stamps = [None] * len(jobs) # of the exported files
+    changed = {} # job index: (stamp of the changed file, time it was seen), exported once it stays the same for an interval (it's being written until then)
+    server = None
+    if args.port is not None:
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.bind(('127.0.0.1', args.port))
+        server.listen()
+        server.settimeout(args.interval)
+    print('Watching ' + str(len(jobs)) + ' cities' + (' (requests on port ' + str(args.port) + ')' if server is not None else '') + ', Ctrl+C to stop')
+    sys.stdout.flush()
+    running = True
+    try:
+        while running:
+            for i in range(len(jobs)):
+                stamp = get_file_stamp(jobs[i]['input'])
+                if stamp is None or stamp == stamps[i]:
+                    changed.pop(i, None)
+                elif i not in changed or changed[i][0] != stamp:
+                    changed[i] = (stamp, time.time())
+                else:
+                    # the latency is from the save, or from when the file was first seen (its save can be long before)
+                    start_time = stamp[0] / 1e9 if stamps[i] is not None else changed[i][1]
+                    del changed[i]
+                    stamps[i] = stamp
+                    export_watched_job(jobs[i], states[i], start_time)
+            if server is None:
+                time.sleep(args.interval)
+                continue
+            try:
+                conn, address = server.accept()
+            except socket.timeout:
+                continue
+            with conn:
+                conn.settimeout(None)
+                running = handle_request(conn, jobs, states, stamps)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if server is not None:
+            server.close()
+    print('Stopped')
+    return 0
+
+if __name__ == '__main__':
+    if len(sys.argv) > 2 and sys.argv[2] == '--batch':
+        sys.exit(run_batch())
+    if len(sys.argv) > 2 and sys.argv[2] == '--watch':
+        sys.exit(run_watch())
 
-    input("Press any key to continue...")
+    try:
+        if len(sys.argv) != 19:
+            raise Exception("Wrong number of arguments, must be 18 (modules path, input json file, output psdl file, and 15 flags), got " + str(len(sys.argv) - 1))
+        flags = {FLAGS[i]: parse_flag(4 + i) for i in range(len(FLAGS))}
+        export_city(sys.argv[2], sys.argv[3], flags)
+        input("Press any key to continue...")
 
-except Exception:
-    traceback.print_exc()
-    input("Press any key to continue...")
+    except Exception:
+        traceback.print_exc()
+        input("Press any key to continue...")
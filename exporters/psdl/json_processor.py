@@ -1,25 +1,81 @@
 import copy
+import multiprocessing
+import os
+import re
+import sys
 import numpy as np
-from utils import state_val, state_bool, state_int
-
-
-class ExportedCityElement:
+from utils import state_val, state_bool, state_int, DisjointSet
+from spatial_index import BoundsGrid
+from element_cache import get_hash
+from element_table import ElementTable, ExportedCityElement
+from profiler import NULL_PROFILER
+
+
+# numbers in the names of the elements that depend on the tasks before theirs (see JsonProcessor.renumber_task_elements)
+FACADE_NAME = re.compile(r'^f(\d+)')
+MESH_INSTANCE_NAME = re.compile(r'^\d+,')
+
+# processor used by the forked workers of JsonProcessor.run_tasks (inherited from the parent process)
+_task_processor = None
+
+def run_task_chunk(processor, chunk):
+    # the elements of all the tasks, the number of elements of each task and the block cells each task looked up
+    table = ElementTable()
+    counts = []
+    cells = []
+    with processor.profiler.stage('task chunk'):
+        for (name, args) in chunk:
+            task_res = []
+            if processor.cache is not None:
+                processor.block_query_cells = set() # dependencies of the task
+            getattr(processor, name)(task_res, *args)
+            table.extend(task_res)
+            counts.append(len(task_res))
+            cells.append(processor.block_query_cells)
+            processor.block_query_cells = None
+    return (table, counts, cells)
+
+def _run_task_chunk(chunk):
+    # the profiler events of the worker are sent back with the elements
+    return run_task_chunk(_task_processor, chunk) + (_task_processor.profiler.take_events(),)
+
+class BlockPerimeterInfo:
+    # cached data of a block perimeter, updated as polygons are added
     def __init__(self):
-        self.is_mesh = False
-        self.name = ''
-        self.mat = ''
-        self.properties = {}
-        self.vertices = []
-        self.indices = []
-        self.normals = []
-        self.uvs = []
-        self.translation = (0,0,0)
-        self.rotation = (0,0,0,1)
-        self.scale = (1,1,1)
+        self.bounds = [[float('inf'), float('inf')], [float('-inf'), float('-inf')]]
+        self.height_sum = 0.0
+        self.height = 0.0
+        self.num_polygons = 0
+        self.num_points = 0
+        self.edges = None
+        self.hash = None
+
+    def add_polygon(self, polygon):
+        if len(polygon) == 0:
+            return
+        bounds = self.bounds
+        h_b = 0.0
+        for v in polygon:
+            if v[0] < bounds[0][0]: bounds[0][0] = v[0]
+            if v[2] < bounds[0][1]: bounds[0][1] = v[2]
+            if v[0] > bounds[1][0]: bounds[1][0] = v[0]
+            if v[2] > bounds[1][1]: bounds[1][1] = v[2]
+            h_b += v[1]
+        h_b /= len(polygon)
+        self.height_sum += h_b
+        self.num_polygons += 1
+        self.num_points += len(polygon)
+        self.height = self.height_sum / self.num_polygons
+        self.edges = None # rebuilt when needed
+        self.hash = None
 
 class JsonProcessor:
-    def __init__(self, data, verbose):
+    def __init__(self, data, verbose, num_workers = None, cache = None, profiler = None):
         self.data = data
+        self.num_workers = num_workers # None: one per core
+        self.cache = cache # ElementCache, to reuse the elements unchanged since the last export
+        self.profiler = profiler if profiler is not None else NULL_PROFILER # ExportProfiler, to time the stages and the slow elements
+        self.block_query_cells = None
         self.cur_facade_index = 0
         self.prop_rules = []
         self.verbose = verbose
@@ -50,33 +106,54 @@ class JsonProcessor:
 
         return res
 
-    def update_perimeter_bounds(self, index):
-        min_x = float('inf')
-        min_y = float('inf')
-        max_x = float('-inf')
-        max_y = float('-inf')
-        blocks = self.block_perimeters[index][0]
-        for block in blocks:
-            for v in block:
-                if v[0] < min_x: min_x = v[0]
-                if v[2] < min_y: min_y = v[2]
-                if v[0] > max_x: max_x = v[0]
-                if v[2] > max_y: max_y = v[2]
-        self.block_perimeters_bounds[index] = [[min_x, min_y], [max_x, max_y]]
+    def add_empty_block_perimeter(self, typ):
+        self.block_perimeters.append([[], typ])
+        self.block_perimeters_info.append(BlockPerimeterInfo())
 
     def add_block_perimeter_multi(self, block, typ):
         self.block_perimeters.append([block, typ])
-        self.block_perimeters_bounds.append(None)
-        self.update_perimeter_bounds(len(self.block_perimeters) - 1)
+        info = BlockPerimeterInfo()
+        for polygon in block:
+            info.add_polygon(polygon)
+        self.block_perimeters_info.append(info)
+        self.block_grid.update(len(self.block_perimeters) - 1, info.bounds)
 
     def add_block_perimeter(self, block, typ):
-        self.block_perimeters.append([[block], typ])
-        self.block_perimeters_bounds.append(None)
-        self.update_perimeter_bounds(len(self.block_perimeters) - 1)
+        self.add_block_perimeter_multi([block], typ)
 
     def extend_block_perimeter(self, perimeter_index, block):
         self.block_perimeters[perimeter_index][0].append(block)
-        self.update_perimeter_bounds(perimeter_index)
+        info = self.block_perimeters_info[perimeter_index]
+        info.add_polygon(block)
+        self.block_grid.update(perimeter_index, info.bounds)
+
+    def get_polygon_edges(self, polygon):
+        # contiguous (n, 2) XZ start points and edge vectors (the last edge closes the polygon)
+        starts = np.ascontiguousarray(np.asarray(polygon, dtype=np.float64).reshape(len(polygon), -1)[:, [0, 2]])
+        return starts, np.roll(starts, -1, axis=0) - starts
+
+    def get_block_edges(self, index):
+        # the edges of all the polygons of a block, with the offset of the first edge of each polygon
+        info = self.block_perimeters_info[index]
+        edges = info.edges
+        if edges is None:
+            starts = []
+            dirs = []
+            offsets = []
+            n = 0
+            for polygon in self.block_perimeters[index][0]:
+                if len(polygon) > 0:
+                    s, d = self.get_polygon_edges(polygon)
+                    starts.append(s)
+                    dirs.append(d)
+                    offsets.append(n)
+                    n += len(s)
+            if len(starts) > 0:
+                edges = (np.concatenate(starts), np.concatenate(dirs), np.array(offsets))
+            else:
+                edges = (np.zeros((0, 2)), np.zeros((0, 2)), np.zeros(0, dtype=int))
+            info.edges = edges
+        return edges
 
     def get_tex(self, tex):
         if tex is None or tex == '': return 'NONE'
@@ -107,6 +184,28 @@ class JsonProcessor:
         i += section_index * n
         return [i+n, i+1+n, i, i+1+n, i+1, i]
 
+    def get_strip_indices(self, n, num_sections, rev):
+        # indices of the quads between consecutive sections of n vertices, same as calling
+        # get_section_indices(_rev)(j, n, i) for each quad, but done by offsetting a template of one section
+        if n < 2 or num_sections < 2:
+            return []
+        get_indices = self.get_section_indices_rev if rev else self.get_section_indices
+        template = np.array([k for j in range(n - 1) for k in get_indices(j, n)])
+        offsets = np.arange(num_sections - 1) * n
+        return (offsets[:, None] + template[None, :]).reshape(-1).tolist()
+
+    def get_section_vertices(self, mesh, num_sections, vps, section_verts):
+        # the given vertices of each section, section by section
+        if len(section_verts) == 0 or num_sections <= 0:
+            return []
+        vertices = mesh['vertices']
+        if isinstance(vertices, np.ndarray):
+            # (sections, vertices per section, 3) view of the mesh
+            return vertices[:(num_sections * vps)].reshape(num_sections, vps, 3)[:, section_verts].reshape(-1, 3)
+        # plain lists: gather the original vertices, converting the whole mesh would cost more
+        idx = (np.arange(num_sections)[:, None] * vps + np.asarray(section_verts)[None, :]).reshape(-1)
+        return [vertices[i] for i in idx.tolist()]
+
     def get_mesh_mat(self, mat_id):
         return self.get_tex(self.data['materialDict'][mat_id]['data']['texture']) if mat_id >= 0 else "NONE"
 
@@ -217,33 +316,13 @@ class JsonProcessor:
                 for i in range(2, 6):
                     comma = ',' if i < 5 else ''
                     textures += self.get_tex(state['texture' + str(i)]) + comma
-        vertices = []
-        shoulder_1_vertices = []
-        shoulder_2_vertices = []
-        indices = []
-        shoulder_1_indices = []
-        shoulder_2_indices = []
-        for i in range(num_segments):
-            # the road mesh
-            for j in section_verts:
-                vertices.append(mesh['vertices'][i * vps + j])
-            if i < num_segments - 1:
-                for j in range(len(section_verts) - 1):
-                    sec_indices = self.get_section_indices_rev(j, len(section_verts), i)
-                    indices.extend(sec_indices)
-            # the shoulders (if present)
-            for j in shoulder_1_section_verts:
-                shoulder_1_vertices.append(mesh['vertices'][i * vps + j])
-            if i < num_segments - 1:
-                for j in range(len(shoulder_1_section_verts) - 1):
-                    sec_indices = self.get_section_indices(j, len(shoulder_1_section_verts), i)
-                    shoulder_1_indices.extend(sec_indices)
-            for j in shoulder_2_section_verts:
-                shoulder_2_vertices.append(mesh['vertices'][i * vps + j])
-            if i < num_segments - 1:
-                for j in range(len(shoulder_2_section_verts) - 1):
-                    sec_indices = self.get_section_indices(j, len(shoulder_2_section_verts), i)
-                    shoulder_2_indices.extend(sec_indices)
+        # the road mesh and the shoulders (if present)
+        vertices = self.get_section_vertices(mesh, num_segments, vps, section_verts)
+        indices = self.get_strip_indices(len(section_verts), num_segments, True)
+        shoulder_1_vertices = self.get_section_vertices(mesh, num_segments, vps, shoulder_1_section_verts)
+        shoulder_1_indices = self.get_strip_indices(len(shoulder_1_section_verts), num_segments, False)
+        shoulder_2_vertices = self.get_section_vertices(mesh, num_segments, vps, shoulder_2_section_verts)
+        shoulder_2_indices = self.get_strip_indices(len(shoulder_2_section_verts), num_segments, False)
         elem = ExportedCityElement()
         elem.indices = indices
         elem.vertices = vertices
@@ -493,22 +572,28 @@ class JsonProcessor:
             in_block.append(block)
 
     def get_split_submeshes(self, mesh):
+        # each submesh with only the vertices it uses (sorted by original index) and remapped indices,
+        # the unique indices of all the submeshes are found together by prefixing them with the submesh number
+        submeshes = mesh['submeshes']
+        counts = [len(sm['indices']) for sm in submeshes]
+        if sum(counts) == 0:
+            return [{'vertices': [], 'indices': []} for sm in submeshes]
+        inds = np.concatenate([np.asarray(sm['indices'], dtype=np.int64).reshape(-1) for sm in submeshes])
+        sm_ids = np.repeat(np.arange(len(submeshes)), counts)
+        n = max(len(mesh['vertices']), int(inds.max()) + 1)
+        unique_keys, inverse = np.unique(sm_ids * n + inds, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        unique_sm_ids = unique_keys // n
+        first_unique = np.searchsorted(unique_sm_ids, np.arange(len(submeshes) + 1))
+        vertices = np.asarray(mesh['vertices'], dtype=np.float64)[unique_keys % n].tolist()
+        local_indices = (inverse - first_unique[sm_ids]).tolist()
         res = []
-        for i in range(len(mesh['submeshes'])):
-            sm = mesh['submeshes'][i]
-            vertices = []
-            indices = []
+        offset = 0
+        for i in range(len(submeshes)):
             p = {}
-            inds = []
-            for ind in sm['indices']:
-                if ind not in inds: inds.append(ind)
-            inds.sort()
-            for ind in inds:
-                vertices.append(mesh['vertices'][ind])
-            for ind in sm['indices']:
-                indices.append(inds.index(ind))
-            p['vertices'] = vertices
-            p['indices'] = indices
+            p['vertices'] = vertices[first_unique[i]:first_unique[i + 1]]
+            p['indices'] = local_indices[offset:(offset + counts[i])]
+            offset += counts[i]
             res.append(p)
         return res
 
@@ -747,41 +832,53 @@ class JsonProcessor:
         else:
             self.extend_block_perimeter(cur_block - 1, block)
 
-    def find_vector(self, lst, item):
-        for i in range(len(lst)):
-            if lst[i] == item:
-                return i
-        return -1
+    def get_point_key(self, p):
+        # quantized point, to compare perimeter points
+        return (round(p[0] * 1000.0), round(p[1] * 1000.0), round(p[2] * 1000.0))
 
-    def is_point_in_block_perimeter(self, block, p):
-        for perimeter in block:
-            if self.find_vector(perimeter, p) != -1:
-                return True
-        return False
+    def get_perimeter_edge_keys(self, perimeter):
+        keys = [self.get_point_key(p) for p in perimeter]
+        res = []
+        for j in range(len(keys)):
+            k0 = keys[j]
+            k1 = keys[0 if (j == len(keys) - 1) else (j + 1)]
+            if k0 != k1:
+                res.append((k0, k1) if k0 < k1 else (k1, k0))
+        return res
 
-    def get_real_patch_block(self, patch):
+    def can_merge_patch(self, patch, manual_blocks):
         state = patch['data']['fields']['state']
-        if not state_bool(state, 'mergeWithConnected'):
+        if state['type'] != 'psdl' or not state_bool(state, 'mergeWithConnected'):
+            return False
+        block_number = self.get_manual_block_number(state)
+        return not (block_number > 0 and block_number in manual_blocks)
+
+    def get_patch_groups(self, manual_blocks):
+        # patches sharing at least one perimeter edge (directly or through other patches) go in the same group
+        patches = self.data['terrainPatches']
+        self.patch_groups = DisjointSet(len(patches))
+        self.patch_group_blocks = {}
+        edge_owners = {}
+        for i in range(len(patches)):
+            if self.can_merge_patch(patches[i], manual_blocks):
+                for key in self.get_perimeter_edge_keys(patches[i]['perimeterPoints']):
+                    if key in edge_owners:
+                        self.patch_groups.union(edge_owners[key], i)
+                    else:
+                        edge_owners[key] = i
+
+    def get_real_patch_block(self, patch, patch_index, manual_blocks):
+        if not self.can_merge_patch(patch, manual_blocks):
             return 0
-        block_perimeters = self.block_perimeters
-        p = patch['perimeterPoints']
-        for i in range(len(block_perimeters)):
-            block = block_perimeters[i]
-            if block[1] == 1:
-                for j in range(len(p)):
-                    v0 = p[j]
-                    v1 = p[0 if (j == len(p) - 1) else (j + 1)]
-                    if self.is_point_in_block_perimeter(block[0], v0) and self.is_point_in_block_perimeter(block[0], v1):
-                        return i + 1
-        return 0
-
-    def get_patch(self, res, patch, manual_blocks):
+        return self.patch_group_blocks.get(self.patch_groups.find(patch_index), 0)
+
+    def get_patch(self, res, patch, patch_index, manual_blocks):
         state = patch['data']['fields']['state']
         if state['type'] != 'psdl':
             return
         block_perimeters = self.block_perimeters
         cur_block = len(block_perimeters) + 1
-        detected_block = self.get_real_patch_block(patch)
+        detected_block = self.get_real_patch_block(patch, patch_index, manual_blocks)
         if detected_block != 0:
             cur_block = detected_block
         block_number = self.get_manual_block_number(state)
@@ -803,6 +900,8 @@ class JsonProcessor:
         if detected_block == 0:
             if cur_block == len(block_perimeters) + 1:
                 self.add_block_perimeter(patch['perimeterPoints'], 1 if state_bool(state, 'mergeWithConnected') else 0)
+                if self.can_merge_patch(patch, manual_blocks):
+                    self.patch_group_blocks[self.patch_groups.find(patch_index)] = cur_block
             else:
                 self.extend_block_perimeter(cur_block - 1, patch['perimeterPoints'])
         else:
@@ -846,6 +945,14 @@ class JsonProcessor:
         num_bounds = (len(coll_verts) // 2) - 1
         bound_indices = [0, 2, 1, 1, 2, 3]
         cur_geo_facade_index = self.cur_facade_index
+        if both_sides and num_bounds > 0:
+            # blocks behind the midpoints of the bottom edges of all the bounds
+            cv = np.asarray(coll_verts[:(num_bounds + 1)], dtype=np.float64)
+            mid_fronts = (cv[:-1] + cv[1:]) * 0.5
+            mid_dirs = np.cross(cv[1:] - cv[:-1], [0, 1, 0])
+            with np.errstate(divide='ignore', invalid='ignore'):
+                mid_dirs /= np.linalg.norm(mid_dirs, axis=1, keepdims=True)
+            blocks2 = self.find_blocks(mid_fronts - 5 * mid_dirs) + 1
         for i in range(num_bounds):
             cv = coll_verts
             nb = num_bounds
@@ -858,11 +965,7 @@ class JsonProcessor:
             elem.properties['original_name'] = obj_name + ' [facade bound]'
             res.append(elem)
             if both_sides:
-                mid_front = np.add(bound_verts[0], bound_verts[1]) * 0.5
-                mid_dir = np.cross(np.subtract(bound_verts[1], bound_verts[0]), [0, 1, 0])
-                mid_dir /= np.linalg.norm(mid_dir)
-                center_point = mid_front - 5 * mid_dir
-                block2 = self.find_block(center_point) + 1
+                block2 = int(blocks2[i])
                 if block2 > 0 and block2 != block:
                     elem2 = copy.deepcopy(elem)
                     elem2.name = 'f' + str(self.cur_facade_index) + 'z*' + ',' + str(block2) + '_FACB'
@@ -873,31 +976,29 @@ class JsonProcessor:
         for facade in side['facades']:
             for key in facade['instances']:
                 mesh = side['meshDict'][int(key)]
-                sstate = side['data']['fields']['state']
                 entry = facade['instances'][key]
-                for batch in entry:
-                    for i in range(len(mesh['submeshes'])):
-                        sm = mesh['submeshes'][i]
-                        if sm['materialId'] != -1:
-                            for j in range(len(batch)):
-                                if len(mesh['vertices']) == 4 and len(mesh['submeshes']) == 1: #TODO: this makes the outer loop useless
-                                    vertices_t = []
-                                    for vi in range(len(mesh['vertices'])):
-                                        v = mesh['vertices'][vi]
-                                        v = np.reshape((v[0], v[1], v[2], 1), (1,4))
-                                        m = np.reshape(batch[j], (4, 4))
-                                        vertices_t.append(np.dot(v, m).reshape(4,1)[:3])
-                                    elem = ExportedCityElement()
-                                    elem.vertices = vertices_t
-                                    elem.indices = sm['indices']
-                                    elem.name = 'f' + str(cur_geo_facade_index) + '+' + ',' + str(block) + '_FAC'
-                                    elem.properties['u_tiling'] = str(-int(mesh['uvs'][0][0]))
-                                    elem.properties['v_tiling'] = str(int(mesh['uvs'][0][1]))
-                                    elem.properties['original_name'] = obj_name + ' [facade]'
-                                    mat_id = sm['materialId']
-                                    mat_tex = mat_dict[mat_id]['data']['texture']
-                                    elem.mat = self.get_tex(mat_tex)
-                                    res.append(elem)
+                if len(mesh['vertices']) != 4 or len(mesh['submeshes']) != 1: #TODO: only single quads are supported
+                    continue
+                sm = mesh['submeshes'][0]
+                matrices = [m for batch in entry for m in batch]
+                if sm['materialId'] == -1 or len(matrices) == 0:
+                    continue
+                # transform the quad with all the instance matrices at once, one (4, 3) slice per instance
+                quad = np.hstack([np.asarray(mesh['vertices'], dtype=np.float64).reshape(4, 3), np.ones((4, 1))])
+                vertices_t = np.matmul(quad, np.reshape(np.asarray(matrices, dtype=np.float64), (-1, 4, 4)))[:, :, :3]
+                u_tiling = str(-int(mesh['uvs'][0][0]))
+                v_tiling = str(int(mesh['uvs'][0][1]))
+                mat_tex = self.get_tex(mat_dict[sm['materialId']]['data']['texture'])
+                for j in range(len(matrices)):
+                    elem = ExportedCityElement()
+                    elem.vertices = vertices_t[j]
+                    elem.indices = sm['indices']
+                    elem.name = 'f' + str(cur_geo_facade_index) + '+' + ',' + str(block) + '_FAC'
+                    elem.properties['u_tiling'] = u_tiling
+                    elem.properties['v_tiling'] = v_tiling
+                    elem.properties['original_name'] = obj_name + ' [facade]'
+                    elem.mat = mat_tex
+                    res.append(elem)
             cur_geo_facade_index += 1
 
         # slivers
@@ -913,43 +1014,37 @@ class JsonProcessor:
             elem.mat = self.get_tex(mat_tex)
             res.append(elem)
 
-    def closest_point(self, point, line_start, line_end):
-        p_m_s = np.subtract(point, line_start)
-        e_m_s = np.subtract(line_end, line_start)
-        val = np.dot(p_m_s, e_m_s) / (np.linalg.norm(e_m_s)**2)
-        t = np.clip(val, 0, 1)
-        return np.add(line_start, np.multiply(t, np.subtract(line_end, line_start)))
-
     def closest_point_to_curve(self, point, curve_points):
-        min_dist = float('inf')
-        min_p = (0.0, 0.0, 0.0)
-        min_i = -1
-        for i in range(len(curve_points) - 1):
-            p0 = curve_points[i]
-            p1 = curve_points[i + 1]
-            p = self.closest_point(point, p0, p1)
-            d = np.linalg.norm(np.subtract(point, p))
-            if d < min_dist:
-                min_i = i
-                min_dist = d
-                min_p = p
-        return (min_p, min_i)
-
-    def get_building(self, res, building, obj_name, front_only, both_sides_parent):
+        # closest point on the curve and index of its segment, all the segments are tested together
+        # (the first one wins if more are at the same distance), ((0, 0, 0), -1) if there's none
+        if len(curve_points) < 2:
+            return ((0.0, 0.0, 0.0), -1)
+        point = np.asarray(point, dtype=np.float64).reshape(3)
+        curve = np.asarray(curve_points, dtype=np.float64).reshape(-1, 3)
+        starts = curve[:-1]
+        dirs = curve[1:] - starts
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip(np.einsum('sk,sk->s', point - starts, dirs) / np.einsum('sk,sk->s', dirs, dirs), 0, 1)
+        closest = starts + t[:, None] * dirs
+        dists = np.linalg.norm(point - closest, axis=1)
+        dists[np.isnan(dists)] = np.inf # degenerate segments
+        best = int(np.argmin(dists))
+        if not np.isfinite(dists[best]):
+            return ((0.0, 0.0, 0.0), -1)
+        return (closest[best], best)
+
+    def get_building_block_points(self, building, front_only):
+        # point used to find the block of the building, and the one to try if it's outside every block
         state = building['data']['fields']['state']
-        block_perimeters = self.block_perimeters
         curve = building['spline']
         curve_n = building['splineActualNormals']
-
-        #find the block(s)
-        both_sides = (front_only and both_sides_parent) or state_bool(state, 'fixBound')
         depth = 1 if front_only else state['depth']
         if front_only and len(curve) > 2:
             center_point = [0,0,0]
             for point in curve:
                 center_point = np.add(center_point, point)
             center_point /= len(curve)
-            block = self.find_block(center_point)
+            return (center_point, None)
         else:
             mid_front = np.add(curve[0], curve[-1]) * 0.5
             mid_front_2, min_i = self.closest_point_to_curve(mid_front, curve)
@@ -958,11 +1053,35 @@ class JsonProcessor:
             mid_dir = np.add(curve_n[0], curve_n[-1])
             mid_dir /= np.linalg.norm(mid_dir)
             center_point = mid_front + 0.5 * depth * mid_dir
-            block = self.find_block(center_point)
-            if block < 0: # try front instead of back (e.g. on road without terrain behind)
+            # try front instead of back (e.g. on road without terrain behind)
+            return (center_point, mid_front - mid_dir)
+
+    def get_building_blocks(self, buildings):
+        # (block, both_sides) for each (building, front_only, both_sides_parent), looked up together
+        points = [self.get_building_block_points(b[0], b[1]) for b in buildings]
+        res = []
+        if len(points) == 0:
+            return res
+        blocks = self.find_blocks([p[0] for p in points])
+        retry = [i for i in range(len(points)) if blocks[i] < 0 and points[i][1] is not None]
+        if len(retry) > 0:
+            blocks[retry] = self.find_blocks([points[i][1] for i in retry])
+        retry = set(retry)
+        for i in range(len(buildings)):
+            building, front_only, both_sides_parent = buildings[i]
+            both_sides = (front_only and both_sides_parent) or state_bool(building['data']['fields']['state'], 'fixBound')
+            if i in retry:
                 both_sides = False
-                center_point = mid_front - mid_dir
-                block = self.find_block(center_point)
+            res.append((int(blocks[i]), both_sides))
+        return res
+
+    def get_building(self, res, building, obj_name, front_only, both_sides_parent, block_info = None):
+        state = building['data']['fields']['state']
+
+        #find the block(s)
+        if block_info is None:
+            block_info = self.get_building_blocks([(building, front_only, both_sides_parent)])[0]
+        block, both_sides = block_info
         if block >= 0:
             block += 1
             for side in ['front', 'left', 'right', 'back']:
@@ -971,53 +1090,85 @@ class JsonProcessor:
             if building['roof'] is not None:
                 self.get_roof(res, building['roof'], block, state['topTexture'], obj_name)
 
-    def get_block_from_line_points(self, line):
+    def get_line_points_center(self, line):
         point_sum = (0.0, 0.0, 0.0)
         for point in line['linePoints']:
             point_sum = np.add(point_sum, point)
-        point_sum = np.divide(point_sum, len(line['linePoints']))
-        return self.find_block(point_sum)
+        return np.divide(point_sum, len(line['linePoints']))
 
-    def get_building_line(self, res, line):
+    def building_line_is_mesh(self, line):
         state = line['data']['fields']['state']
         instance_state = line['data']['fields']['instanceState']
-        to_pkg = state_bool(instance_state, "exportToPKG")
-        if state['type'] != 'psdl' or to_pkg:
-            block = self.get_block_from_line_points(line) + 1
+        return state['type'] != 'psdl' or state_bool(instance_state, "exportToPKG")
+
+    def get_building_line_blocks(self, lines):
+        # (line block, [(block, both_sides) for each building]) for each building line, looked up together
+        line_queries = [i for i in range(len(lines)) if self.building_line_is_mesh(lines[i]) or lines[i]['roof'] is not None]
+        line_blocks = [-1] * len(lines)
+        if len(line_queries) > 0:
+            found_blocks = self.find_blocks([self.get_line_points_center(lines[i]) for i in line_queries])
+            for i in range(len(line_queries)):
+                line_blocks[line_queries[i]] = int(found_blocks[i])
+        buildings = []
+        for line in lines:
+            if not self.building_line_is_mesh(line):
+                state = line['data']['fields']['state']
+                for building in line['buildings']:
+                    buildings.append((building, state_bool(state, 'frontOnly'), state_bool(state, 'fixBound')))
+        building_blocks = self.get_building_blocks(buildings)
+        res = []
+        cur = 0
+        for i in range(len(lines)):
+            num_buildings = 0 if self.building_line_is_mesh(lines[i]) else len(lines[i]['buildings'])
+            res.append((line_blocks[i], building_blocks[cur:(cur + num_buildings)]))
+            cur += num_buildings
+        return res
+
+    def get_building_line(self, res, line, blocks = None):
+        state = line['data']['fields']['state']
+        if blocks is None:
+            blocks = self.get_building_line_blocks([line])[0]
+        line_block, building_blocks = blocks
+        if self.building_line_is_mesh(line):
+            block = line_block + 1
             elem = self.get_mesh(line['data']['mesh'], block, 'VL', line['data']['name'])
             bnd = self.get_mesh(line['data']['collider'], block, 'BND', line['data']['name'], self.cur_mesh_idx - 1)
             res.append(elem)
             res.append(bnd)
         else:
             if line['roof'] is not None:
-                block = self.get_block_from_line_points(line)
+                block = line_block
                 if block >= 0 and 'roof' in line:
                     roof_tex = state_val(state, 'roofTex', '')
                     self.get_roof(res, line['roof'], block + 1, roof_tex, line['data']['name'])
-            for building in line['buildings']:
-                self.get_building(res, building, line['data']['name'], state_bool(state, 'frontOnly'), state_bool(state, 'fixBound'))
-
-    def does_ray_intersect_segment(self, point, direction, p1, p2):
-        v1 = np.subtract(point, p1)
-        v2 = np.subtract(p2, p1)
-        v3 = (-direction[1], direction[0])
-        dot = np.dot(v2, v3)
-        if abs(dot) < 0.0001:
-            return False
-        t1 = np.cross(v2, v1) / np.dot(v2, v3)
-        t2 = np.dot(v1, v3) / np.dot(v2, v3)
-        return t1 >= 0 and t2 >= 0 and t2 < 1 # exclude ==1 because we are testing consecutive segments
-
-    def is_point_inside_polygon(self, point, polygon):
-        count = 0
-        pointb = (point[0], point[2])
-        for i in range(len(polygon)):
-            p1 = polygon[i]
-            p2 = polygon[(i + 1) if (i < len(polygon) - 1) else 0]
-            p1b = (p1[0], p1[2])
-            p2b = (p2[0], p2[2])
-            count += 1 if self.does_ray_intersect_segment(pointb, (1.0, 0.0), p1b, p2b) else 0
-        return count % 2 != 0
+            for i in range(len(line['buildings'])):
+                self.get_building(res, line['buildings'][i], line['data']['name'], state_bool(state, 'frontOnly'), state_bool(state, 'fixBound'), building_blocks[i])
+
+    def get_building_line_counters(self, line, blocks):
+        # how much the facade and mesh indices advance when exporting the building line
+        if self.building_line_is_mesh(line):
+            return (0, 1)
+        num_facades = 0
+        for i in range(len(line['buildings'])):
+            building = line['buildings'][i]
+            if blocks[1][i][0] >= 0:
+                for side in ['front', 'left', 'right', 'back']:
+                    if building[side] is not None:
+                        num_facades += max(0, (len(building[side]['data']['collider']['vertices']) // 2) - 1)
+        return (num_facades, 0)
+
+    def get_ray_crossings(self, point, starts, dirs):
+        # which edges are crossed by a ray going from the point towards +X
+        # (point can also be a (m, 1, 3) array, giving a result for each point)
+        point = np.asarray(point, dtype=np.float64)
+        v1_x = point[..., 0] - starts[:, 0]
+        v1_z = point[..., 2] - starts[:, 1]
+        dot = dirs[:, 1]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t1 = (dirs[:, 0] * v1_z - dot * v1_x) / dot
+            t2 = v1_z / dot
+        # exclude t2 == 1 because we are testing consecutive segments
+        return (np.abs(dot) >= 0.0001) & (t1 >= 0) & (t2 >= 0) & (t2 < 1)
 
     def is_point_in_bounds(self, point, bounds):
         return point[0] >= bounds[0][0] and \
@@ -1025,34 +1176,59 @@ class JsonProcessor:
                point[2] >= bounds[0][1] and \
                point[2] <= bounds[1][1]
 
-    def is_point_in_block(self, block, point, bounds):
-        if not self.is_point_in_bounds(point, bounds):
+    def is_point_in_block(self, index, point):
+        if not self.is_point_in_bounds(point, self.block_perimeters_info[index].bounds):
             return False
-        for polygon in block:
-            if self.is_point_inside_polygon(point, polygon):
-                return True
-        return False
+        return bool(self.are_points_in_block(index, np.reshape(point, (1, 3)))[0])
+
+    def are_points_in_block(self, index, points):
+        # points: (m, 3) array, the bounds are not checked here
+        starts, dirs, offsets = self.get_block_edges(index)
+        res = np.zeros(len(points), dtype=bool)
+        if len(starts) == 0:
+            return res
+        chunk = max(1, (1 << 20) // len(starts)) # limit the size of the (points, edges) arrays
+        for i in range(0, len(points), chunk):
+            crossings = self.get_ray_crossings(points[i:(i + chunk), None, :], starts, dirs)
+            counts = np.add.reduceat(crossings.astype(np.int32), offsets, axis=1)
+            res[i:(i + chunk)] = np.any(counts % 2 != 0, axis=1)
+        return res
 
-    def get_block_height(self, block):
-        h = 0.0
-        for polygon in block:
-            h_b = 0.0
-            for point in polygon:
-                h_b += point[1]
-            h_b /= len(polygon)
-            h += h_b
-        h /= len(block)
-        return h
+    def get_block_height(self, index):
+        return self.block_perimeters_info[index].height
+
+    def get_block_hash(self, index):
+        # hash of everything find_block uses of the block
+        info = self.block_perimeters_info[index]
+        if info.hash is None:
+            starts, dirs, offsets = self.get_block_edges(index)
+            info.hash = get_hash((starts.tobytes(), dirs.tobytes(), offsets.tobytes(), info.height))
+        return info.hash
+
+    def get_block_cell_hash(self, cell):
+        # hash of the blocks that can be found from a cell of the block grid
+        if cell not in self.block_cell_hashes:
+            items = self.block_grid.get_cell_items(cell)
+            self.block_cell_hashes[cell] = get_hash([(i, self.get_block_hash(i)) for i in items])
+        return self.block_cell_hashes[cell]
+
+    def are_block_cells_unchanged(self, cell_hashes):
+        for cell in cell_hashes:
+            if self.get_block_cell_hash(cell) != cell_hashes[cell]:
+                return False
+        return True
 
     def find_block(self, pos):
-        block_perimeters = self.block_perimeters
         block = -1
         blocks = []
         heights = []
-        for i in range(len(block_perimeters)):
-            if self.is_point_in_block(block_perimeters[i][0], pos, self.block_perimeters_bounds[i]):
+        cell = self.block_grid.get_query_cell(pos[0], pos[2])
+        if self.block_query_cells is not None:
+            self.block_query_cells.add(cell)
+        for i in self.block_grid.get_cell_items(cell):
+            if self.is_point_in_block(i, pos):
                 blocks.append(i)
-                heights.append(self.get_block_height(block_perimeters[i][0]))
+                heights.append(self.get_block_height(i))
         if len(blocks) > 0:
             block = blocks[0]
             dist = abs(pos[1] - heights[0])
@@ -1063,6 +1239,35 @@ class JsonProcessor:
                     block = blocks[i]
         return block
 
+    def find_blocks(self, points):
+        # same as find_block, for a (m, 3) array of points
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        res = np.full(len(points), -1, dtype=int)
+        dists = np.zeros(len(points))
+        candidates = {}
+        for j in range(len(points)):
+            cell = self.block_grid.get_query_cell(points[j][0], points[j][2])
+            if self.block_query_cells is not None:
+                self.block_query_cells.add(cell)
+            for i in self.block_grid.get_cell_items(cell):
+                candidates.setdefault(i, []).append(j)
+        for i in sorted(candidates): # ascending order, like in find_block
+            idx = np.array(candidates[i])
+            bounds = self.block_perimeters_info[i].bounds
+            p = points[idx]
+            in_bounds = (p[:, 0] >= bounds[0][0]) & (p[:, 0] <= bounds[1][0]) & (p[:, 2] >= bounds[0][1]) & (p[:, 2] <= bounds[1][1])
+            idx = idx[in_bounds]
+            if len(idx) == 0:
+                continue
+            idx = idx[self.are_points_in_block(i, points[idx])]
+            if len(idx) == 0:
+                continue
+            dist = np.abs(points[idx, 1] - self.get_block_height(i))
+            closer = (res[idx] < 0) | (dist < dists[idx])
+            res[idx[closer]] = i
+            dists[idx[closer]] = dist[closer]
+        return res
+
     def get_cube(self, scale):
         def get_face(a, b, c, d):
             return [a, b, c, a, c, d]
@@ -1085,7 +1290,18 @@ class JsonProcessor:
         indices.extend(get_face(7, 4, 0, 3))
         return {'vertices': vertices, 'indices': indices}
 
-    def get_mesh_instance(self, res, mesh, index):
+    def get_mesh_instance_position(self, mesh):
+        # the point used to find the block of the mesh instance
+        mref = mesh['reference']
+        dict_mesh = self.data['meshDict'][mref['meshId']]
+        return np.add(mref['position'], (0.0, dict_mesh['boundsMin'][1], 0.0))
+
+    def mesh_instance_needs_block(self, mesh):
+        state = mesh['settings']
+        is_traffic_light = state_val(state, '_parameterName') in ("startTrafficLight", "endTrafficLight")
+        return not is_traffic_light and not state_bool(state, 'prop')
+
+    def get_mesh_instance(self, res, mesh, index, block = None):
         def get_instance_mesh_name(dict):
             mesh_name_parts = dict['name'].replace('\\', '/').split('/')
             mesh_name = mesh_name_parts[-1].split('.')[0]
@@ -1112,10 +1328,11 @@ class JsonProcessor:
                 elem.mat = 'NONE'
                 res.append(elem)
         else:
-            block = 0
             is_prop = state_bool(state, 'prop')
-            if not is_prop:
-                block = self.find_block(np.add(mref['position'], (0.0, dict_mesh['boundsMin'][1], 0.0)))
+            if is_prop:
+                block = 0
+            elif block is None:
+                block = self.find_block(self.get_mesh_instance_position(mesh))
             if block >= 0 or is_prop:
                 cur_block = block + 1
                 elem = ExportedCityElement()
@@ -1224,19 +1441,129 @@ class JsonProcessor:
         traffic_elem.mat = 'NONE'
         res.append(traffic_elem)
 
+    def get_building_line_task(self, res, index, facade_index, mesh_idx, blocks):
+        line = self.data['buildingLines'][index]
+        if self.verbose: print("exporting " + line['data']['name'])
+        self.cur_facade_index = facade_index
+        self.cur_mesh_idx = mesh_idx
+        with self.profiler.element(line['data']['name']):
+            self.get_building_line(res, line, blocks)
+
+    def get_mesh_instance_task(self, res, index, block):
+        mesh = self.sorted_meshes[index]
+        if self.verbose: print("exporting " + mesh['name'])
+        with self.profiler.element(mesh['name']):
+            self.get_mesh_instance(res, mesh, index, block)
+
+    def get_task_inputs(self, name, args):
+        # the data a task reads besides the block perimeters (with its blocks), but not its position in the export,
+        # so adding or removing an element doesn't change the inputs of the next ones
+        if name == 'get_building_line_task':
+            return (self.data['buildingLines'][args[0]], args[3])
+        mesh = self.sorted_meshes[args[0]]
+        road_id = state_val(mesh['settings'], '_parentObjectId', -1)
+        return (mesh, self.data['meshDict'][mesh['reference']['meshId']], self.road_map.get(road_id), args[1])
+
+    def get_task_numbering(self, name, args):
+        # the indices in the names of the elements of a task, they depend on the tasks before it:
+        # (facade index, mesh index) for a building line, (index,) for a mesh instance
+        if name == 'get_building_line_task':
+            return args[1:3]
+        return args[:1]
+
+    def get_task_key(self, task, materials_hash):
+        name, args = task
+        return get_hash((self.cache.version, name, self.get_task_inputs(name, args), materials_hash))
+
+    def renumber_task_elements(self, name, table, old_numbering, new_numbering):
+        # the cached elements of a task with the numbering of this export, only copied if it changed
+        if old_numbering == new_numbering:
+            return table
+        if name == 'get_building_line_task':
+            facade_offset = new_numbering[0] - old_numbering[0]
+            mesh_offset = new_numbering[1] - old_numbering[1]
+            def rename(name, properties):
+                name = FACADE_NAME.sub(lambda m: 'f' + str(int(m.group(1)) + facade_offset), name)
+                if 'pkg_name' in properties:
+                    properties = dict(properties, pkg_name='mesh' + str(int(properties['pkg_name'][4:]) + mesh_offset))
+                return (name, properties)
+        else:
+            def rename(name, properties):
+                return (MESH_INSTANCE_NAME.sub(str(new_numbering[0]) + ',', name), properties)
+        return table.get_renamed(rename)
+
+    def get_num_workers(self, num_tasks):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return 1 # the city data can't be shared with the workers
+        num_workers = self.num_workers if self.num_workers is not None else (os.cpu_count() or 1)
+        return max(1, min(num_workers, num_tasks // 256)) # small cities aren't worth the overhead
+
+    def run_tasks(self, tasks, materials_hash = None):
+        # runs the (method name, args) tasks, yields the elements of each task in order, as (table, start, end),
+        # the ones in the cache are reused if the blocks they looked up didn't change (materials_hash is needed for the cache)
+        keys = [None] * len(tasks)
+        cached = [None] * len(tasks)
+        if self.cache is not None:
+            self.block_cell_hashes = {}
+            for i in range(len(tasks)):
+                keys[i] = self.get_task_key(tasks[i], materials_hash)
+                cached[i] = self.cache.get(keys[i], self.are_block_cells_unchanged)
+        chunks = self.run_uncached_tasks([tasks[i] for i in range(len(tasks)) if cached[i] is None])
+        counts = []
+        j = 0
+        for i in range(len(tasks)):
+            if cached[i] is not None:
+                numbering, table = cached[i]
+                table = self.renumber_task_elements(tasks[i][0], table, numbering, self.get_task_numbering(*tasks[i]))
+                yield (table, 0, len(table))
+                continue
+            while j >= len(counts):
+                table, counts, cells, events = next(chunks)
+                self.profiler.add_events(events)
+                start = 0
+                j = 0
+            end = start + counts[j]
+            if self.cache is not None:
+                deps = {cell: self.get_block_cell_hash(cell) for cell in cells[j]}
+                self.cache.put(keys[i], deps, (self.get_task_numbering(*tasks[i]), table.get_range(start, end)))
+            yield (table, start, end)
+            start = end
+            j += 1
+
+    def run_uncached_tasks(self, tasks, chunk_size = 256):
+        # yields the results of run_task_chunk for consecutive chunks of the tasks, with the profiler events of the workers,
+        # the tasks must not change the state of the processor that later tasks depend on
+        global _task_processor
+        num_workers = self.get_num_workers(len(tasks))
+        if num_workers <= 1:
+            for i in range(0, len(tasks), chunk_size):
+                yield run_task_chunk(self, tasks[i:(i + chunk_size)]) + ([],)
+            return
+        chunk_size = min(chunk_size, (len(tasks) + num_workers * 4 - 1) // (num_workers * 4))
+        chunks = [tasks[i:(i + chunk_size)] for i in range(0, len(tasks), chunk_size)]
+        _task_processor = self
+        try:
+            sys.stdout.flush() # or the forked workers would print again what is still buffered
+            # forked workers share the city data and the block perimeters with this process
+            with multiprocessing.get_context('fork').Pool(num_workers) as pool:
+                for chunk_res in pool.imap(_run_task_chunk, chunks):
+                    yield chunk_res
+        finally:
+            _task_processor = None
+
     def get_objects(self):
         if self.out_res is not None:
             return self.out_res
 
-        res = []
+        res = ElementTable() # each element gets packed in it as soon as it's done
         data = self.data
 
         manual_blocks = self.get_manual_blocks()
         self.block_perimeters = []
-        self.block_perimeters_bounds = []
+        self.block_perimeters_info = []
+        self.block_grid = BoundsGrid()
         for num in manual_blocks:
-            self.block_perimeters.append([[], 0])
-            self.block_perimeters_bounds.append([[float('-inf'), float('-inf')], [float('inf'), float('inf')]])
+            self.add_empty_block_perimeter(0)
 
         self.traffic_roads = []
         # traffic_roads: (ExportedCityElement elem, RoadGenerator road, State instanceState, int id, int[] blocks)[]
@@ -1245,52 +1572,92 @@ class JsonProcessor:
 
         # process the elements
         print("processing roads...")
-        for road in data['roads']:
-            if self.verbose: print("exporting " + road['data']['name'])
-            instance_state = road['data']['fields']['instanceState']
-            has_start_int = road['startIntersectionId'] != -1
-            has_end_int = road['endIntersectionId'] != -1
-            self.get_road(res, road, instance_state, has_start_int, has_end_int, None, -1, manual_blocks)
+        with self.profiler.stage('roads', res.get_counts):
+            for road in data['roads']:
+                if self.verbose: print("exporting " + road['data']['name'])
+                instance_state = road['data']['fields']['instanceState']
+                has_start_int = road['startIntersectionId'] != -1
+                has_end_int = road['endIntersectionId'] != -1
+                elems = []
+                with self.profiler.element(road['data']['name']):
+                    self.get_road(elems, road, instance_state, has_start_int, has_end_int, None, -1, manual_blocks)
+                res.extend(elems)
 
         print("processing intersections...")
-        for intersection in data['intersections']:
-            if self.verbose: print("exporting " + intersection['data']['name'])
-            self.get_intersection(res, intersection, manual_blocks)
+        with self.profiler.stage('intersections', res.get_counts):
+            for intersection in data['intersections']:
+                if self.verbose: print("exporting " + intersection['data']['name'])
+                elems = []
+                with self.profiler.element(intersection['data']['name']):
+                    self.get_intersection(elems, intersection, manual_blocks)
+                res.extend(elems)
 
         print("processing terrain patches...")
-        for patch in data['terrainPatches']:
-            if self.verbose: print("exporting " + patch['data']['name'])
-            self.get_patch(res, patch, manual_blocks)
-
-        print("processing building lines...")
-        for line in data['buildingLines']:
-            if self.verbose: print("exporting " + line['data']['name'])
-            self.get_building_line(res, line)
+        with self.profiler.stage('terrain patches', res.get_counts):
+            self.get_patch_groups(manual_blocks)
+            for i in range(len(data['terrainPatches'])):
+                patch = data['terrainPatches'][i]
+                if self.verbose: print("exporting " + patch['data']['name'])
+                elems = []
+                with self.profiler.element(patch['data']['name']):
+                    self.get_patch(elems, patch, i, manual_blocks)
+                res.extend(elems)
+
+        # the block perimeters are complete, the elements below only look them up
 
         # Traffic data
+        with self.profiler.stage('traffic', lambda: dict(res.get_counts(), traffic_elements=len(traffic_res))):
+            # first create lookup tables
+            self.road_map = {}
+            for i in range(len(self.traffic_roads)):
+                self.road_map[self.traffic_roads[i][1]['id']] = i
+
+            self.intersection_map = {}
+            for i in range(len(self.traffic_intersections)):
+                self.intersection_map[self.traffic_intersections[i][1]['id']] = i
+
+            # then process the elements
+            traffic_res = []
+            for obj in self.traffic_roads:
+                self.get_traffic_road(traffic_res, obj)
+
+            for obj in self.traffic_intersections:
+                self.get_traffic_intersection(traffic_res, obj)
+
+        # find the blocks of the building lines and mesh instances, and the facade and mesh indices each line starts from,
+        # so they can then be exported independently (and in parallel)
+        with self.profiler.stage('building and mesh blocks', res.get_counts):
+            line_tasks = []
+            line_blocks = self.get_building_line_blocks(data['buildingLines'])
+            for i in range(len(data['buildingLines'])):
+                line_tasks.append(('get_building_line_task', (i, self.cur_facade_index, self.cur_mesh_idx, line_blocks[i])))
+                num_facades, num_meshes = self.get_building_line_counters(data['buildingLines'][i], line_blocks[i])
+                self.cur_facade_index += num_facades
+                self.cur_mesh_idx += num_meshes
+
+            # Sort order of INST meshes can matter for rendering when transparent objects are involved, here the current order gets preserved
+            self.sorted_meshes = sorted(data['meshInstances'], key=lambda mesh: mesh['name'])
+            sorted_meshes = self.sorted_meshes
+            mesh_blocks = [None] * len(sorted_meshes)
+            block_queries = [i for i in range(len(sorted_meshes)) if self.mesh_instance_needs_block(sorted_meshes[i])]
+            if len(block_queries) > 0:
+                found_blocks = self.find_blocks([self.get_mesh_instance_position(sorted_meshes[i]) for i in block_queries])
+                for i in range(len(block_queries)):
+                    mesh_blocks[block_queries[i]] = int(found_blocks[i])
+            mesh_tasks = [('get_mesh_instance_task', (i, mesh_blocks[i])) for i in range(len(sorted_meshes))]
+            # all the tasks read the materials, they are only hashed once
+            materials_hash = get_hash(data['materialDict']) if self.cache is not None else None
 
-        # first create lookup tables
-        self.road_map = {}
-        for i in range(len(self.traffic_roads)):
-            self.road_map[self.traffic_roads[i][1]['id']] = i
-
-        self.intersection_map = {}
-        for i in range(len(self.traffic_intersections)):
-            self.intersection_map[self.traffic_intersections[i][1]['id']] = i
-
-        # then process the elements
-        for obj in self.traffic_roads:
-            self.get_traffic_road(res, obj)
-
-        for obj in self.traffic_intersections:
-            self.get_traffic_intersection(res, obj)
+        print("processing building lines...")
+        with self.profiler.stage('building lines', res.get_counts):
+            for elems in self.run_tasks(line_tasks, materials_hash):
+                res.extend(*elems)
+            res.extend(traffic_res)
 
-        # Sort order of INST meshes can matter for rendering when transparent objects are involved, here the current order gets preserved
-        sorted_meshes = sorted(data['meshInstances'], key=lambda mesh: mesh['name'])
         print("processing meshes...") #done at the end to access traffic info (for traffic lights)
-        for i in range(len(sorted_meshes)):
-            if self.verbose: print("exporting " + sorted_meshes[i]['name'])
-            self.get_mesh_instance(res, sorted_meshes[i], i)
+        with self.profiler.stage('meshes', res.get_counts):
+            for elems in self.run_tasks(mesh_tasks, materials_hash):
+                res.extend(*elems)
 
         self.out_res = res
 
@@ -0,0 +1,220 @@
+import hashlib
+import io
+import locale
+import os
+import struct
+from utils import create_folder_if_not_exists
+
+
+def get_file_hash(path, size):
+    # sha1 of the existing file, None if it doesn't exist or has a different size (no need to read it then)
+    try:
+        if os.path.getsize(path) != size:
+            return None
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(2**20), b''):
+                sha1.update(chunk)
+        return sha1.digest()
+    except OSError:
+        return None
+
+class OutputTextFile(io.StringIO):
+    # text file built in memory, given to the output layer when closed (same newline and encoding handling as open)
+    def __init__(self, output, path, newline = None, encoding = None):
+        super().__init__(newline='')
+        self.output = output
+        self.path = path
+        self.newline_out = newline
+        self.encoding_out = encoding if encoding is not None else locale.getpreferredencoding(False)
+
+    def close(self):
+        if not self.closed:
+            text = self.getvalue()
+            if self.newline_out is None:
+                text = text.replace('\n', os.linesep)
+            elif self.newline_out not in ['', '\n']:
+                text = text.replace('\n', self.newline_out)
+            self.output.write(self.path, text.encode(self.encoding_out))
+        super().close()
+
+class OutputBinaryFile(io.BytesIO):
+    # binary file built in memory, given to the output layer when closed
+    def __init__(self, output, path):
+        super().__init__()
+        self.output = output
+        self.path = path
+
+    def close(self):
+        if not self.closed:
+            self.output.write(self.path, self.getvalue())
+        super().close()
+
+class OutputStreamFile:
+    # binary file written to a temporary file as it's built (hashed by chunks), so it's never held in memory as a whole,
+    # given to the output layer when closed, which keeps it only if its content changed
+    def __init__(self, output, path, chunk_size = 2**20):
+        self.output = output
+        self.path = path
+        self.tmp_path = path + '.tmp'
+        self.chunk_size = chunk_size
+        self.file = open(self.tmp_path, 'wb')
+        self.buffer = bytearray() # the small writes are hashed and written together
+        self.sha1 = hashlib.sha1()
+        self.size = 0
+        self.closed = False
+
+    def flush_buffer(self):
+        self.sha1.update(self.buffer)
+        self.file.write(self.buffer)
+        self.size += len(self.buffer)
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        if len(self.buffer) >= self.chunk_size:
+            self.flush_buffer()
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            self.flush_buffer()
+            self.file.close()
+            self.closed = True
+            self.output.write_from(self.path, self.tmp_path, self.size, self.sha1.digest())
+
+class OutputFiles:
+    # output layer of the exporters: the text files are built in memory and the binary ones streamed to a temporary file,
+    # then written only if their content changed,
+    # through a temporary file so they are never left half written (the unchanged ones keep their modification time),
+    # the exporters use one when they are given no output
+    def __init__(self):
+        self.files_written = 0
+        self.files_skipped = 0
+        self.bytes_written = 0
+        self.bytes_skipped = 0
+        self.last_file = (None, None) # (path, content), copied without reading it back
+
+    def open(self, path, mode = 'w', newline = None, encoding = None):
+        # in place of the built-in open, for writing only (the binary files can be big, they are streamed)
+        if 'b' in mode:
+            return OutputStreamFile(self, path)
+        return OutputTextFile(self, path, newline, encoding)
+
+    def is_unchanged(self, path, size, digest):
+        if get_file_hash(path, size) == digest:
+            self.files_skipped += 1
+            self.bytes_skipped += size
+            return True
+        return False
+
+    def replace(self, tmp_path, path, size):
+        os.replace(tmp_path, path)
+        self.files_written += 1
+        self.bytes_written += size
+
+    def write(self, path, content):
+        self.last_file = (path, content)
+        if self.is_unchanged(path, len(content), hashlib.sha1(content).digest()):
+            return False
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(content)
+        self.replace(tmp_path, path, len(content))
+        return True
+
+    def write_from(self, path, tmp_path, size, digest):
+        # for a file already written to tmp_path, with its size and sha1
+        if self.is_unchanged(path, size, digest):
+            os.remove(tmp_path)
+            return False
+        self.replace(tmp_path, path, size)
+        return True
+
+    def create_folder(self, path):
+        create_folder_if_not_exists(path)
+
+    def copy(self, source, destination):
+        if self.last_file[0] == source:
+            return self.write(destination, self.last_file[1])
+        with open(source, 'rb') as f:
+            return self.write(destination, f.read())
+
+    def get_summary(self):
+        return '{} files written ({:.1f} KB), {} unchanged ({:.1f} KB)'.format(
+            self.files_written, self.bytes_written / 1024, self.files_skipped, self.bytes_skipped / 1024)
+
+    def print_summary(self, name):
+        print(name + ': ' + self.get_summary())
+
+class ArchiveOutputFiles(OutputFiles):
+    # in-memory virtual file system, the files are kept (by normalized path) to be written in an archive
+    def __init__(self):
+        super().__init__()
+        self.files = {}
+
+    def open(self, path, mode = 'w', newline = None, encoding = None):
+        # the binary files are kept in memory too, they go in the archive
+        if 'b' in mode:
+            return OutputBinaryFile(self, path)
+        return OutputTextFile(self, path, newline, encoding)
+
+    def write(self, path, content):
+        self.last_file = (path, content)
+        self.files[os.path.normpath(path)] = content
+        self.files_written += 1
+        self.bytes_written += len(content)
+        return True
+
+    def create_folder(self, path):
+        pass # the folders are only in the archive
+
+    def copy(self, source, destination):
+        content = self.files.get(os.path.normpath(source))
+        if content is None:
+            with open(source, 'rb') as f:
+                content = f.read()
+        return self.write(destination, content)
+
+    def get_summary(self):
+        return '{} files ({:.1f} KB) kept for the archive'.format(self.files_written, self.bytes_written / 1024)
+
+def get_archive_name(path, city_path):
+    # name in the archive of an exported file, city_path is the output file without extension (folder/city):
+    # folder/city_tune/* goes in tune/, folder/city_race/* in race/, and the other files of the city (folder/city.*, folder/city/*) in city/
+    root, city = os.path.split(os.path.normpath(city_path))
+    name = os.path.relpath(os.path.normpath(path), root).replace(os.sep, '/')
+    first, _, rest = name.partition('/')
+    if first == '..':
+        raise Exception(path + ' is not in the folder of the city')
+    if first == city + '_tune':
+        return 'tune/' + rest
+    if first == city + '_race':
+        return 'race/' + rest
+    return 'city/' + name
+
+def align(value, alignment):
+    return (value + alignment - 1) // alignment * alignment
+
+def get_archive(files, alignment = 2048):
+    # MM2 archive (DAVE, uncompressed) with the files (name: content): a 16 bytes header (magic, number of files, size of the
+    # directory, size of the names), the directory at the alignment, then the names, then the data,
+    # each directory entry is (name offset, data offset, size, packed size), sorted by name as the game looks them up by bisection
+    names = sorted(files, key=lambda name: name.lower())
+    name_table = bytearray()
+    name_offsets = []
+    for name in names:
+        name_offsets.append(len(name_table))
+        name_table += name.encode('ascii') + b'\0'
+    dir_size = align(16 * len(names), alignment)
+    names_size = align(len(name_table), alignment)
+    offset = alignment + dir_size + names_size
+    directory = bytearray()
+    for i in range(len(names)):
+        size = len(files[names[i]])
+        directory += struct.pack('<4I', name_offsets[i], offset, size, size)
+        offset += size
+    header = b'DAVE' + struct.pack('<3I', len(names), dir_size, names_size)
+    parts = [header.ljust(alignment, b'\0'), bytes(directory).ljust(dir_size, b'\0'), bytes(name_table).ljust(names_size, b'\0')]
+    parts.extend(files[name] for name in names)
+    return b''.join(parts)
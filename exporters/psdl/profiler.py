@@ -0,0 +1,276 @@
+import json
+import os
+import time
+import tracemalloc
+import psutil
+
+
+class NullTimer:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+NULL_TIMER = NullTimer()
+
+class NullProfiler:
+    # used when profiling is disabled, the timers do nothing
+    enabled = False
+
+    def stage(self, name, counts = None):
+        return NULL_TIMER
+
+    def element(self, name):
+        return NULL_TIMER
+
+    def take_events(self):
+        return []
+
+    def add_events(self, events):
+        pass
+
+    def stop(self):
+        pass
+
+NULL_PROFILER = NullProfiler()
+
+class ProfilerTimer:
+    def __init__(self, profiler, name, category, threshold, counts = None):
+        self.profiler = profiler
+        self.name = name
+        self.category = category
+        self.threshold = threshold
+        self.counts = counts
+        self.start = 0
+
+    def tracks_memory(self):
+        # only the stages of the main process, the workers don't send their memory data back
+        return self.category == 'stage' and self.profiler.memory and os.getpid() == self.profiler.pid
+
+    def __enter__(self):
+        if self.tracks_memory():
+            self.profiler.start_memory_stage()
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        duration = time.perf_counter() - self.start
+        # the pid is taken here as the elements can be processed in forked workers
+        pid = os.getpid()
+        rss = self.profiler.get_rss() if self.category == 'stage' and pid == self.profiler.pid else None
+        if duration >= self.threshold:
+            self.profiler.events.append((self.name, self.category, pid, self.start, duration, rss))
+        if self.tracks_memory():
+            self.profiler.end_memory_stage(self.name, self.start, duration, self.counts, rss)
+        return False
+
+def reset_traced_peak():
+    # not available before python 3.9, the peaks are then the ones since the start of the export
+    if hasattr(tracemalloc, 'reset_peak'):
+        tracemalloc.reset_peak()
+
+def get_allocation_sites(snapshot, ignored_files):
+    # allocated size and number of blocks for each line (filtered here, snapshot.filter_traces is much slower)
+    sites = {}
+    for stat in snapshot.statistics('lineno'):
+        frame = stat.traceback[0]
+        if frame.filename not in ignored_files:
+            sites[frame.filename + ':' + str(frame.lineno)] = (stat.size, stat.count)
+    return sites
+
+class ExportProfiler:
+    # times the stages of the export and the elements slower than element_threshold (in seconds),
+    # the events are (name, category, pid, start, duration, rss at the end of the stage), with the times from time.perf_counter,
+    # with memory set it also records the memory use of each stage (RSS, tracemalloc peak and allocation sites, element counts),
+    # this makes the export slower, so the timings are not meaningful
+    def __init__(self, memory = False, element_threshold = 0.005, top_sites = 10):
+        self.enabled = True
+        self.memory = memory
+        self.element_threshold = element_threshold
+        self.top_sites = top_sites
+        self.events = []
+        self.pid = os.getpid()
+        self.origin = time.perf_counter()
+        self.memory_stages = []
+        self.memory_stack = [] # data of the running stages
+        self.memory_samples = [] # (time, rss), for the trace
+        self.process = psutil.Process()
+        self.started_tracing = memory and not tracemalloc.is_tracing() # only stopped if it was started here
+        if memory:
+            self.ignored_files = [tracemalloc.__file__, __file__]
+            tracemalloc.start()
+
+    def stage(self, name, counts = None):
+        # counts: function returning a dict with the number of elements, vertices etc. held at the end of the stage
+        return ProfilerTimer(self, name, 'stage', 0, counts)
+
+    def element(self, name):
+        return ProfilerTimer(self, name, 'element', self.element_threshold)
+
+    def stop(self):
+        # ends the memory tracing, once the export is done
+        if self.started_tracing:
+            tracemalloc.stop()
+            self.started_tracing = False
+
+    def take_events(self):
+        # the events recorded so far by this process, removed from the profiler (to send them from a worker to the main process,
+        # a forked worker also has a copy of the events recorded before the fork)
+        pid = os.getpid()
+        events = [e for e in self.events if e[2] == pid]
+        self.events = []
+        return events
+
+    def add_events(self, events):
+        self.events.extend(events)
+
+    def get_rss(self):
+        rss = self.process.memory_info().rss
+        self.memory_samples.append((time.perf_counter(), rss))
+        return rss
+
+    def update_traced_peak(self):
+        # the tracemalloc peak is reset when a stage starts, so the running stages get the peak reached so far
+        current, peak = tracemalloc.get_traced_memory()
+        for stage in self.memory_stack:
+            stage['peak'] = max(stage['peak'], peak)
+        return current
+
+    def start_memory_stage(self):
+        traced = self.update_traced_peak()
+        stage = {
+            'depth': len(self.memory_stack),
+            'start_rss': self.get_rss(),
+            'start_traced': traced,
+            'peak': traced,
+            'sites': get_allocation_sites(tracemalloc.take_snapshot(), self.ignored_files)
+        }
+        self.memory_stack.append(stage)
+        reset_traced_peak() # after the snapshot, which is not part of the stage
+
+    def end_memory_stage(self, name, start, duration, counts, end_rss):
+        traced = self.update_traced_peak()
+        stage = self.memory_stack.pop()
+        end_sites = get_allocation_sites(tracemalloc.take_snapshot(), self.ignored_files)
+        # the lines that allocated the most memory kept at the end of the stage
+        diffs = []
+        for site in end_sites:
+            size, count = end_sites[site]
+            start_size, start_count = stage['sites'].get(site, (0, 0))
+            if size > start_size:
+                diffs.append({'site': site, 'size_diff': size - start_size, 'count_diff': count - start_count, 'size': size})
+        diffs.sort(key=lambda d: -d['size_diff'])
+        self.memory_stages.append({
+            'name': name,
+            'depth': stage['depth'],
+            'start': start - self.origin,
+            'duration': duration,
+            'start_rss': stage['start_rss'],
+            'end_rss': end_rss,
+            'start_traced': stage['start_traced'],
+            'end_traced': traced,
+            'peak_traced': stage['peak'],
+            'counts': counts() if counts is not None else {},
+            'top_allocations': diffs[:self.top_sites]
+        })
+        reset_traced_peak()
+
+    def get_stages(self):
+        # (depth, event) for each stage, in order, the stages are nested if they were running one inside the other
+        stages = sorted([e for e in self.events if e[1] == 'stage' and e[2] == self.pid], key=lambda e: (e[3], -e[4]))
+        res = []
+        stack = []
+        for stage in stages:
+            while len(stack) > 0 and stage[3] >= stack[-1][3] + stack[-1][4]:
+                stack.pop()
+            res.append((len(stack), stage))
+            stack.append(stage)
+        return res
+
+    def write_trace(self, filename):
+        # chrome trace event format (chrome://tracing or ui.perfetto.dev), the workers are shown as threads of the export
+        trace_events = []
+        pids = []
+        for (name, category, pid, start, duration, rss) in self.events:
+            if pid not in pids:
+                pids.append(pid)
+            trace_events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': (start - self.origin) * 1e6,
+                'dur': duration * 1e6,
+                'pid': self.pid,
+                'tid': pid,
+                'args': {'rss_mb': rss / 2**20} if rss is not None else {}
+            })
+        for (sample_time, rss) in self.memory_samples:
+            trace_events.append({'name': 'rss', 'ph': 'C', 'ts': (sample_time - self.origin) * 1e6, 'pid': self.pid, 'args': {'MB': rss / 2**20}})
+        for pid in pids:
+            thread_name = 'export' if pid == self.pid else 'worker ' + str(pid)
+            trace_events.append({'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': pid, 'args': {'name': thread_name}})
+        with open(filename, 'w') as f:
+            json.dump({'traceEvents': trace_events, 'displayTimeUnit': 'ms'}, f)
+        print("Trace written to " + filename)
+
+    def get_stage_totals(self):
+        # calls, total time and RSS at the end of the last call of each stage, in order
+        totals = []
+        keys = {}
+        for (depth, stage) in self.get_stages():
+            key = (depth, stage[0])
+            if key not in keys:
+                keys[key] = len(totals)
+                totals.append({'name': stage[0], 'depth': depth, 'calls': 0, 'time': 0, 'rss': None})
+            total = totals[keys[key]]
+            total['calls'] += 1
+            total['time'] += stage[4]
+            total['rss'] = stage[5]
+        return totals
+
+    def get_summary(self, max_elements = 20):
+        totals = self.get_stage_totals()
+        total_time = sum(total['time'] for total in totals if total['depth'] == 0)
+        lines = ['{:<40} {:>7} {:>10} {:>7} {:>9}'.format('stage', 'calls', 'time (s)', '%', 'RSS (MB)')]
+        for total in totals:
+            percent = 100 * total['time'] / total_time if total_time > 0 else 0
+            lines.append('{:<40} {:>7} {:>10.3f} {:>6.1f}% {:>9.1f}'.format(
+                ('  ' * total['depth'] + total['name'])[:40], total['calls'], total['time'], percent, total['rss'] / 2**20))
+        elements = sorted([e for e in self.events if e[1] == 'element'], key=lambda e: -e[4])
+        if len(elements) > 0:
+            lines.append('')
+            lines.append(str(len(elements)) + ' elements took more than ' + str(self.element_threshold * 1000) + ' ms, slowest:')
+            for elem in elements[:max_elements]:
+                lines.append('{:<50} {:>10.1f} ms'.format(elem[0][:50], elem[4] * 1000))
+        return '\n'.join(lines)
+
+    def print_summary(self):
+        print(self.get_summary())
+
+    def get_memory_report(self):
+        stages = sorted(self.memory_stages, key=lambda s: (s['start'], -s['duration']))
+        return {
+            'format': 1,
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'peak_rss': max([rss for (t, rss) in self.memory_samples], default=0),
+            'peak_traced': max([s['peak_traced'] for s in stages], default=0),
+            'stages': stages
+        }
+
+    def write_memory_report(self, filename):
+        # sizes in bytes, times in seconds from the start of the export
+        with open(filename, 'w') as f:
+            json.dump(self.get_memory_report(), f, indent=1)
+        print("Memory report written to " + filename)
+
+    def print_memory_summary(self):
+        report = self.get_memory_report()
+        mb = 2**20
+        print('{:<40} {:>9} {:>9} {:>9} {:>9}  {}'.format('stage', 'RSS (MB)', 'diff', 'peak', 'traced', 'counts'))
+        for stage in report['stages']:
+            counts = ', '.join(str(stage['counts'][key]) + ' ' + key for key in stage['counts'])
+            print('{:<40} {:>9.1f} {:>+9.1f} {:>9.1f} {:>9.1f}  {}'.format(
+                ('  ' * stage['depth'] + stage['name'])[:40], stage['end_rss'] / mb, (stage['end_rss'] - stage['start_rss']) / mb,
+                stage['peak_traced'] / mb, stage['end_traced'] / mb, counts))
+        print('peak RSS: {:.1f} MB, tracemalloc peak: {:.1f} MB'.format(report['peak_rss'] / mb, report['peak_traced'] / mb))
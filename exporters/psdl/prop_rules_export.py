@@ -1,25 +1,41 @@
 import sys
 import csv
-from utils import clean_city_path, create_folder_if_not_exists
+from utils import clean_city_path
+from output_files import OutputFiles
 
 
+def get_fingerprint(value):
+    # hashable value equal for equal (json) values, the keys of the dicts are sorted
+    if isinstance(value, dict):
+        return (dict, tuple(sorted((key, get_fingerprint(value[key])) for key in value)))
+    if isinstance(value, (list, tuple)):
+        return (list, tuple(get_fingerprint(v) for v in value))
+    return value
+
 class PropRulesExporter:
-    def __init__(self, json_processor, verbose):
+    def __init__(self, json_processor, verbose, output = None):
         self.json_processor = json_processor
         self.verbose = verbose
+        self.output = output if output is not None else OutputFiles()
 
     def export_props_rules(self, filename):
         #get the unique elements
+        # (indexed by their fingerprint, equal elements have the same one)
         elems = []
+        elem_indices = {}
         for rules in self.json_processor.prop_rules:
             for rule in rules:
+                if rule is None:
+                    continue
                 for elem in rule['elements']:
-                    if elem not in elems:
-                        elems.append(elem)
+                    key = get_fingerprint(elem)
+                    if key not in elem_indices:
+                        elem_indices[key] = len(elems)
+                        elems.append(dict(elem)) # copied, as the name can change
 
         # get the new rules in the new format
         # (with indices instead of names since they could change names later)
-        # (the name change cannot be done earlier otherwise the index function would not work)
+        # (the name change cannot be done earlier otherwise the index lookup would not work)
         new_rules = []
         n = 0
         for rule in self.json_processor.prop_rules:
@@ -33,23 +49,27 @@ class PropRulesExporter:
             new_right = {'name': n_name + 'right', 'elems': []}
             if left is not None:
                 for elem in left['elements']:
-                    new_left['elems'].append(elems.index(elem))
+                    new_left['elems'].append(elem_indices[get_fingerprint(elem)])
             if right is not None:
                 for elem in right['elements']:
-                    new_right['elems'].append(elems.index(elem))
+                    new_right['elems'].append(elem_indices[get_fingerprint(elem)])
             new_rule['leftRule'] = new_left
             new_rule['rightRule'] = new_right
             new_rules.append(new_rule)
 
         # make names unique
-        taken_names = []
+        # (the number to try next for each name is kept, the taken names only grow so the lower ones are still taken)
+        taken_names = set()
+        next_numbers = {}
         for elem in elems:
-            if elem['name'] in taken_names:
-                n = 2
-                while (elem['name'] + str(n)) in taken_names:
+            name = elem['name']
+            if name in taken_names:
+                n = next_numbers.get(name, 2)
+                while (name + str(n)) in taken_names:
                     n += 1
-                elem['name'] += str(n)
-            taken_names.append(elem['name'])
+                next_numbers[name] = n + 1
+                elem['name'] = name + str(n)
+            taken_names.add(elem['name'])
 
         # assign the modified elements
         for i in range(len(new_rules)):
@@ -92,10 +112,10 @@ class PropRulesExporter:
             return new_row
 
         foldername = clean_city_path(filename) + '/'
-        create_folder_if_not_exists(foldername)
+        self.output.create_folder(foldername)
 
         #rules
-        f_rules = open(foldername + 'proprules.csv', 'w', newline='')
+        f_rules = self.output.open(foldername + 'proprules.csv', 'w', newline='')
         writer = csv.writer(f_rules)
         header = ['rulename', 'prop1', 'prop2', 'prop3', 'prop4', 'prop5', 'prop6', 'prop7', 'prop8']
         writer.writerow(header)
@@ -107,7 +127,7 @@ class PropRulesExporter:
         f_rules.close()
 
         #defs
-        f_defs = open(foldername + 'propdefs.csv', 'w', newline='')
+        f_defs = self.output.open(foldername + 'propdefs.csv', 'w', newline='')
         writer = csv.writer(f_defs)
         header = ['name', 'start', 'distance', 'maxUse', 'minLerp', 'maxLerp', 'file1', 'file2', 'file3', 'file4', '']
         writer.writerow(header)
@@ -122,3 +142,4 @@ class PropRulesExporter:
             writer.writerow(clean_row(row, len(header)))
         f_defs.close()
         print("Prop rules exported!")
+        self.output.print_summary("prop rules")
@@ -0,0 +1,176 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+from element_cache import get_core_version
+
+# Golden output regression test of the export: runs benchmark.py on each fixture city (in its own process),
+# hashes every output file (BIN, PSDL, INST, BAI, PATHSET, prop rules, cinfo, aimap, opp...) and compares them to the goldens,
+# the timing and memory of each run are stored next to the goldens, to compare the performance between versions
+# usage: python regression.py [--fixtures 1000:0 path/to/city.json ...] [--update] [--record]
+# the goldens (regression_goldens.json) are not in the repository, as the outputs depend on the common submodule and on numpy,
+# they are created once with --update, from the exporter before the changes to test and with the numpy of pythonInfo/requirements.txt:
+#   git checkout <baseline> && python regression.py --update && git checkout - && python regression.py
+
+FOLDER = os.path.dirname(os.path.abspath(__file__))
+DEFAULT_FIXTURES = ['100:0', '1000:1', '10000:2'] # synthetic cities, number of elements:seed
+IGNORED_SUFFIXES = ['.benchmark.json', '.trace.json', '.memory.json', '.cache']
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Golden output regression test of the PSDL export')
+    parser.add_argument('--fixtures', nargs='+', default=DEFAULT_FIXTURES,
+                        help='synthetic cities (number of elements:seed) or exported city json files')
+    parser.add_argument('--modules', default=None, help='modules path (with DecodeExportedJson), needed for the city json files')
+    parser.add_argument('--goldens', default=os.path.join(FOLDER, 'regression_goldens.json'), help='file with the goldens')
+    parser.add_argument('--output', default='regression', help='folder for the exported files')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes for the building lines and meshes')
+    parser.add_argument('--update', action='store_true', help='store the current outputs as the goldens (and this run as the performance reference)')
+    parser.add_argument('--record', action='store_true', help='add this run to the performance history of the fixtures that match their goldens')
+    return parser.parse_args()
+
+def get_fixture_name(fixture):
+    if ':' in fixture and not os.path.isfile(fixture):
+        elements, seed = fixture.split(':')
+        return 'synthetic_' + elements + '_s' + seed
+    return os.path.splitext(os.path.basename(fixture))[0]
+
+def get_file_hashes(folder):
+    # sha1 of each output file, by path relative to the folder
+    hashes = {}
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            if any(name.endswith(suffix) for suffix in IGNORED_SUFFIXES):
+                continue
+            path = os.path.join(root, name)
+            with open(path, 'rb') as f:
+                hashes[os.path.relpath(path, folder).replace(os.sep, '/')] = hashlib.sha1(f.read()).hexdigest()
+    return dict(sorted(hashes.items()))
+
+def run_fixture(fixture, folder, args):
+    # exports the fixture in an empty folder, returns the benchmark report (None if the export failed) and the output
+    if os.path.exists(folder):
+        shutil.rmtree(folder)
+    os.makedirs(folder)
+    command = [sys.executable, os.path.join(FOLDER, 'benchmark.py'), '--output', folder]
+    if ':' in fixture and not os.path.isfile(fixture):
+        elements, seed = fixture.split(':')
+        command += [elements, '--seed', seed]
+    else:
+        command += ['--city', fixture]
+        if args.modules is not None:
+            command += ['--modules', args.modules]
+    if args.workers is not None:
+        command += ['--workers', str(args.workers)]
+    result = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    reports = [name for name in os.listdir(folder) if name.endswith('.benchmark.json')]
+    if len(reports) == 0:
+        return (None, result.stdout)
+    with open(os.path.join(folder, reports[0]), 'r') as f:
+        return (json.load(f), result.stdout)
+
+def get_run_info(report):
+    version = get_core_version()
+    return {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'core_version': version[1],
+        'core_feature_version': version[2],
+        'sources': version[3][:12],
+        'workers': report['workers'],
+        'total_time': report['total_time'],
+        'peak_rss': report['peak_rss'],
+        'stages': {stage['name']: {'time': stage['time'], 'rss': stage['rss']} for stage in report['stages'] if stage['depth'] == 0},
+        'outputs': report['outputs'] # time of each output, they run at the same time
+    }
+
+def compare_hashes(golden_hashes, hashes):
+    # list of (file, problem)
+    diffs = []
+    for name in golden_hashes:
+        if name not in hashes:
+            diffs.append((name, 'missing'))
+        elif hashes[name] != golden_hashes[name]:
+            diffs.append((name, 'different'))
+    for name in hashes:
+        if name not in golden_hashes:
+            diffs.append((name, 'new'))
+    return diffs
+
+def print_performance(run, reference, label):
+    mb = 2**20
+    print('    {:<36} {:>10} {:>10} {:>8} {:>10} {:>10}'.format('stage (vs ' + label + ')', 'before (s)', 'now (s)', 'speedup', 'RSS before', 'RSS now'))
+    rows = [(name, reference['stages'].get(name), run['stages'][name]) for name in run['stages']]
+    reference_outputs = reference.get('outputs', {})
+    for name in run['outputs']:
+        before = {'time': reference_outputs[name], 'rss': None} if name in reference_outputs else None
+        rows.append(('  ' + name, before, {'time': run['outputs'][name], 'rss': None}))
+    rows.append(('total', {'time': reference['total_time'], 'rss': reference['peak_rss']}, {'time': run['total_time'], 'rss': run['peak_rss']}))
+    for (name, before, now) in rows:
+        if before is None:
+            print('    {:<36} {:>10} {:>10.3f}'.format(name[:36], '-', now['time']))
+            continue
+        speedup = before['time'] / now['time'] if now['time'] > 0 else 0
+        rss_before = '{:.1f}'.format(before['rss'] / mb) if before['rss'] is not None else '-'
+        rss_now = '{:.1f}'.format(now['rss'] / mb) if now['rss'] is not None else '-'
+        print('    {:<36} {:>10.3f} {:>10.3f} {:>7.2f}x {:>10} {:>10}'.format(name[:36], before['time'], now['time'], speedup, rss_before, rss_now))
+
+def main():
+    args = parse_args()
+    goldens = {'format': 1, 'fixtures': {}}
+    if os.path.isfile(args.goldens):
+        with open(args.goldens, 'r') as f:
+            goldens = json.load(f)
+    failed = []
+    for fixture in args.fixtures:
+        name = get_fixture_name(fixture)
+        print('fixture ' + name + '...')
+        report, output = run_fixture(fixture, os.path.join(args.output, name), args)
+        if report is None or len(report['errors']) > 0:
+            print(output)
+            print('  FAILED: the export did not complete')
+            failed.append(name)
+            continue
+        hashes = get_file_hashes(os.path.join(args.output, name))
+        run = get_run_info(report)
+        golden = goldens['fixtures'].get(name)
+
+        if args.update:
+            goldens['fixtures'][name] = {'fixture': fixture, 'files': hashes, 'reference': run, 'history': [run]}
+            print('  goldens updated (' + str(len(hashes)) + ' files)')
+            continue
+        if golden is None:
+            print('  FAILED: no goldens (create them with --update from the baseline exporter, see the top of regression.py)')
+            failed.append(name)
+            continue
+        diffs = compare_hashes(golden['files'], hashes)
+        if len(diffs) > 0:
+            print('  FAILED: ' + str(len(diffs)) + ' files differ from the goldens')
+            for (file, problem) in diffs:
+                print('    ' + file + ': ' + problem)
+            failed.append(name)
+        else:
+            print('  OK (' + str(len(hashes)) + ' files identical)')
+            if args.record:
+                golden['history'].append(run)
+        print_performance(run, golden['reference'], 'reference')
+        if len(golden['history']) > 0 and golden['history'][-1] is not run:
+            print_performance(run, golden['history'][-1], 'last recorded')
+
+    if args.update or args.record:
+        tmp_path = args.goldens + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(goldens, f, indent=1)
+        os.replace(tmp_path, args.goldens)
+        print('goldens written to ' + args.goldens)
+    if len(failed) > 0:
+        print(str(len(failed)) + ' of ' + str(len(args.fixtures)) + ' fixtures failed: ' + ', '.join(failed))
+        return 1
+    if not args.update:
+        print('all ' + str(len(args.fixtures)) + ' fixtures match their goldens')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
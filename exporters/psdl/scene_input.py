@@ -5,10 +5,19 @@ from common.file_io import BinaryFileHelper
 
 
 class StandaloneSceneInput(SceneInput):
-    def __init__(self, filepath):
+    def __init__(self, filepath, table = None):
+        # if an ElementTable is given the objects are taken from it instead of reading the BIN file
         self.filepath = filepath
         self.obj_list = []
-        self.read()
+        self.type_index = {}
+        self.block_index = {}
+        self.block_type_index = {}
+        self.original_name_index = {}
+        if table is not None:
+            self.read_table(table)
+        else:
+            self.read()
+        self.build_index()
 
     def create_obj(self):
         obj = {}
@@ -21,6 +30,8 @@ class StandaloneSceneInput(SceneInput):
         obj["scale"] = [1, 1, 1]
         obj["rotation"] = [1, 0, 0, 0]
         obj["properties"] = {}
+        obj["block"] = None
+        obj["type"] = ""
         return obj
 
     def read(self):
@@ -82,6 +93,108 @@ class StandaloneSceneInput(SceneInput):
         print("BIN file imported!")
         file.close()
 
+    def read_table(self, table):
+        # same objects as read() gives for the BIN file of the table, built from its buffers
+        # (vectors in x, z, y order, indices reversed, quaternions as -w, x, z, y)
+        vertices = table.get_vertex_array()[:, [0, 2, 1]].tolist()
+        normals = table.get_normal_array()[:, [0, 2, 1]].tolist()
+        uvs = table.get_uv_array().tolist()
+        indices = table.get_index_array().tolist()
+        transforms = table.get_transform_array().tolist()
+        for i in range(len(table)):
+            is_mesh = table.is_mesh[i] > 0
+            v0 = table.vertex_starts[i]
+            verts = list(map(tuple, vertices[v0:(v0 + table.vertex_counts[i])]))
+            i0 = table.index_starts[i]
+            if is_mesh:
+                elem_indices = []
+                s0 = table.submesh_starts[i]
+                for size in table.submesh_sizes[s0:(s0 + table.submesh_counts[i])]:
+                    elem_indices.append(indices[i0:(i0 + size)][::-1])
+                    i0 += size
+                n0 = table.normal_starts[i]
+                elem_normals = list(map(tuple, normals[n0:(n0 + table.normal_counts[i])]))
+                u0 = table.uv_starts[i]
+                elem_uvs = list(map(tuple, uvs[u0:(u0 + table.uv_counts[i])]))
+            else:
+                elem_indices = indices[i0:(i0 + table.index_counts[i])][::-1]
+                elem_normals = None
+                elem_uvs = None
+            materials = table.mats[i].split(',')
+
+            #create the object
+            obj = self.create_obj()
+            obj["properties"]["is_mesh"] = is_mesh
+            obj["name"] = table.names[i]
+            obj["vertices"] = verts
+            obj["indices"] = elem_indices
+            obj["normals"] = elem_normals
+            obj["uvs"] = elem_uvs
+            for j in range(len(materials)):
+                obj["properties"]["texture" + str(j)] = materials[j]
+            if not table.transform_is_identity[i]:
+                t = transforms[i]
+                obj["rotation"] = (-t[6], t[3], t[5], t[4])
+                obj["scale"] = (t[7], t[9], t[8])
+                obj["location"] = (t[0], t[2], t[1])
+            properties = table.properties[i]
+            for p_key in properties:
+                obj["properties"][p_key] = properties[p_key]
+            self.obj_list.append(obj)
+        self.obj_list = sorted(self.obj_list, key=lambda x: x['name'])
+        print("BIN data imported!")
+
+    def parse_object_name(self, name):
+        # names are in the form [<prefix>,]<block>_<TYPE> (e.g. 'f3*,12_FACB', '4,7_INST', '0_BAI')
+        base = name.split(',')[-1]
+        parts = base.split('_', 1)
+        if len(parts) < 2:
+            return (None, base)
+        block = int(parts[0]) if parts[0].isdigit() else None
+        return (block, parts[1])
+
+    def build_index(self):
+        # the lists keep the order of obj_list (sorted by name)
+        self.type_index = {}
+        self.block_index = {}
+        self.block_type_index = {}
+        self.original_name_index = {}
+        for obj in self.obj_list:
+            block, typ = self.parse_object_name(obj["name"])
+            obj["block"] = block
+            obj["type"] = typ
+            self.type_index.setdefault(typ, []).append(obj)
+            if block is not None:
+                self.block_index.setdefault(block, []).append(obj)
+                self.block_type_index.setdefault((block, typ), []).append(obj)
+            original_name = obj["properties"].get("original_name")
+            if original_name is not None:
+                self.original_name_index.setdefault(original_name, []).append(obj)
+
+    def get_object_types(self):
+        return list(self.type_index.keys())
+
+    def get_objects_by_type(self, typ):
+        return self.type_index.get(typ, [])
+
+    def get_block_numbers(self):
+        return sorted(self.block_index.keys())
+
+    def get_objects_by_block(self, block):
+        return self.block_index.get(block, [])
+
+    def get_objects_by_block_and_type(self, block, typ):
+        return self.block_type_index.get((block, typ), [])
+
+    def get_objects_by_original_name(self, original_name):
+        return self.original_name_index.get(original_name, [])
+
+    def get_object_block(self, obj):
+        return obj["block"]
+
+    def get_object_type(self, obj):
+        return obj["type"]
+
     def init_progress_bar(self):
         pass
 
@@ -160,6 +273,52 @@ class StandaloneSceneInput(SceneInput):
     def get_polygon(self, obj, i):
         return obj["indices"][(i * 3) : ((i + 1) * 3)]
 
+    def get_polygon_array(self, obj):
+        # (n, 3) index array, cached until the object's index list is replaced
+        indices = obj["indices"]
+        cache = obj.get("polygon_array")
+        if cache is None or cache[0] is not indices or cache[1] != len(indices):
+            if obj["properties"].get("is_mesh", False):
+                flat = [i for sub in indices for i in sub]
+            else:
+                flat = indices
+            array = np.asarray(flat, dtype=np.int64)
+            array = array[:(len(array) // 3) * 3].reshape(-1, 3)
+            cache = (indices, len(indices), array)
+            obj["polygon_array"] = cache
+        return cache[2]
+
+    def get_vertex_array(self, obj):
+        # (n, 3) array of the transformed vertices
+        vertices = obj["vertices"]
+        cache = obj.get("vertex_array")
+        if cache is None or cache[0] is not vertices or cache[1] != len(vertices):
+            array = np.asarray(vertices, dtype=np.float64).reshape(-1, 3)
+            transformed = obj["location"] != [0, 0, 0] or obj["scale"] != [1, 1, 1] or obj["rotation"] != [1, 0, 0, 0]
+            if transformed and len(array) > 0:
+                matrix = self.get_transform_matrix(obj)
+                array = np.matmul(array, matrix[:3, :3].T) + matrix[:3, 3]
+            cache = (vertices, len(vertices), array)
+            obj["vertex_array"] = cache
+        return cache[2]
+
+    def get_polygon_vertex_array(self, obj):
+        # (n, 3, 3) array with the transformed vertices of each triangle
+        return self.get_vertex_array(obj)[self.get_polygon_array(obj)]
+
+    def get_polygon_normal_array(self, obj):
+        # (n, 3) array of unit triangle normals (zero for degenerate triangles)
+        tris = self.get_polygon_vertex_array(obj)
+        normals = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+        lengths = np.linalg.norm(normals, axis=1, keepdims=True)
+        return np.divide(normals, lengths, out=np.zeros_like(normals), where=lengths > 0)
+
+    def get_bounds(self, obj):
+        vertices = self.get_vertex_array(obj)
+        if len(vertices) == 0:
+            return None
+        return (vertices.min(axis=0), vertices.max(axis=0))
+
     def get_position(self, obj):
         return obj["location"]
 
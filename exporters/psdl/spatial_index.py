@@ -0,0 +1,109 @@
+import math
+
+
+class BoundsGrid:
+    # Uniform grid over axis aligned 2D bounds ([[min_x, min_y], [max_x, max_y]]),
+    # used to find the few items whose bounds can contain a point.
+    # Items covering too many cells (or with infinite bounds) are always returned.
+    def __init__(self, cell_size = 64.0, max_cells_per_item = 4096):
+        self.cell_size = cell_size
+        self.max_cells_per_item = max_cells_per_item
+        self.cells = {}
+        self.item_ranges = {}
+        self.oversized = set()
+
+    def get_cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def get_cell_range(self, bounds):
+        if bounds is None:
+            return None
+        min_x, min_y = bounds[0]
+        max_x, max_y = bounds[1]
+        if min_x > max_x or min_y > max_y:
+            return None # empty bounds, nothing can be inside
+        if not all(math.isfinite(v) for v in (min_x, min_y, max_x, max_y)):
+            return 'oversized'
+        c0 = self.get_cell(min_x, min_y)
+        c1 = self.get_cell(max_x, max_y)
+        if (c1[0] - c0[0] + 1) * (c1[1] - c0[1] + 1) > self.max_cells_per_item:
+            return 'oversized'
+        return (c0, c1)
+
+    def remove(self, item):
+        cell_range = self.item_ranges.pop(item, None)
+        if cell_range == 'oversized':
+            self.oversized.discard(item)
+        elif cell_range is not None:
+            c0, c1 = cell_range
+            for cx in range(c0[0], c1[0] + 1):
+                for cy in range(c0[1], c1[1] + 1):
+                    cell = self.cells[(cx, cy)]
+                    cell.discard(item)
+                    if len(cell) == 0:
+                        del self.cells[(cx, cy)]
+
+    def update(self, item, bounds):
+        cell_range = self.get_cell_range(bounds)
+        if item in self.item_ranges and self.item_ranges[item] == cell_range:
+            return
+        self.remove(item)
+        if cell_range is None:
+            return
+        self.item_ranges[item] = cell_range
+        if cell_range == 'oversized':
+            self.oversized.add(item)
+        else:
+            c0, c1 = cell_range
+            for cx in range(c0[0], c1[0] + 1):
+                for cy in range(c0[1], c1[1] + 1):
+                    self.cells.setdefault((cx, cy), set()).add(item)
+
+    def get_query_cell(self, x, y):
+        # cell containing the point, None if the point is not finite (only oversized items can contain it)
+        if not (math.isfinite(x) and math.isfinite(y)):
+            return None
+        return self.get_cell(x, y)
+
+    def get_cell_items(self, cell):
+        # candidate items of a cell returned by get_query_cell, in ascending order
+        items = self.cells.get(cell) if cell is not None else None
+        if items is None:
+            return sorted(self.oversized)
+        if len(self.oversized) == 0:
+            return sorted(items)
+        return sorted(items | self.oversized)
+
+class PointGrid:
+    # Uniform grid over 2D points, used to find the nearest point within a radius.
+    def __init__(self, cell_size = 16.0):
+        self.cell_size = cell_size
+        self.cells = {}
+        self.points = []
+
+    def get_cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def add(self, x, y):
+        # returns the index of the point
+        self.points.append((x, y))
+        self.cells.setdefault(self.get_cell(x, y), []).append(len(self.points) - 1)
+        return len(self.points) - 1
+
+    def nearest(self, x, y, radius):
+        # index of the nearest point within the radius (the first added one if several are at the same distance), None if there's none
+        if not (math.isfinite(x) and math.isfinite(y)):
+            return None
+        c0 = self.get_cell(x - radius, y - radius)
+        c1 = self.get_cell(x + radius, y + radius)
+        best = None
+        best_dist = radius * radius
+        for cx in range(c0[0], c1[0] + 1):
+            for cy in range(c0[1], c1[1] + 1):
+                for i in self.cells.get((cx, cy), []):
+                    px, py = self.points[i]
+                    dist = (px - x) * (px - x) + (py - y) * (py - y)
+                    if dist < best_dist or (dist == best_dist and (best is None or i < best)):
+                        best = i
+                        best_dist = dist
+        return best
@@ -0,0 +1,485 @@
+import copy
+import math
+import random
+
+
+# Generator of synthetic cities, in the same structure returned by DecodeExportedJson
+# (roads, intersections, terrain patches, building lines, mesh instances and city properties),
+# laid out as a grid of intersections connected by roads, with the cells filled by terrain patches,
+# a building line and mesh instances, for benchmarks (see benchmark.py) and tests of the exporter.
+
+SPACING = 100.0
+INTERSECTION_RADIUS = 15.0
+ROAD_HALF_WIDTH = 12.0
+
+def vec(x, y, z):
+    return (float(x), float(y), float(z))
+
+def lerp(a, b, t):
+    return tuple(a[k] + (b[k] - a[k]) * t for k in range(3))
+
+def get_road_section_layout(state):
+    # number of vertices per section of a road, following JsonProcessor.get_psdl_road
+    if not state['isDouble']:
+        return 2
+    sw_skip = 0
+    if state['hasSidewalks']:
+        sw_skip = 2 if state['flatSidewalk'] else 3
+    has_div = state['divider'] > 0
+    cur_v = 0
+    if sw_skip == 3:
+        cur_v += 1
+    cur_v += sw_skip + 1
+    cur_v += 1
+    if has_div:
+        cur_v += 1
+    cur_v += 1 + sw_skip
+    if sw_skip == 3:
+        cur_v += 1
+    return cur_v
+
+def get_material_dict():
+    textures = ['road', 'sidewalk', 'lod', 'divider', 'grass', 'facade1', 'facade2', 'roof', 'sliver', 'crosswalk', 'rail']
+    return [{'data': {'texture': 'texture/' + tex + '.tex'}} for tex in textures]
+
+def get_mesh_dict():
+    names = ['geometry/tree.pkg', 'geometry/bench.pkg', 'geometry/sp_traflitsingle_f.pkg', 'geometry/house.pkg', 'geometry/lamp.pkg']
+    return [{'name': name, 'boundsMin': (-1.0, -0.5 * (i % 2), -1.0)} for i, name in enumerate(names)]
+
+def get_flat_mesh(vertices, indices, material_id):
+    return {
+        'vertices': vertices,
+        'normals': [vec(0, 1, 0) for v in vertices],
+        'uvs': [(v[0] * 0.1, v[2] * 0.1) for v in vertices],
+        'submeshes': [{'indices': indices, 'materialId': material_id}],
+    }
+
+def get_fan_indices(n, offset = 0):
+    res = []
+    for i in range(1, n - 1):
+        res.extend([offset, offset + i, offset + i + 1])
+    return res
+
+class SyntheticCityGenerator:
+    def __init__(self, num_elements, seed = 0):
+        self.num_elements = max(num_elements, 10)
+        self.rng = random.Random(seed)
+        # each grid node gives about 5.5 elements (intersection, 2 roads, 1.5 patches and a building line),
+        # then mesh instances are added in the cells up to the number of elements, about 3.5 per node,
+        # the minimum is 10 elements (2x2 grid), the city has exactly the number of elements from there
+        self.grid_size = max(2, int(round(math.sqrt(self.num_elements / 9.0))))
+        # the roads share a few prop rules, as in real cities (the game allows up to 99)
+        self.prop_rules = [self.get_prop_rule() for k in range(16)]
+
+    def get_node_pos(self, i, j):
+        return vec(i * SPACING, self.get_height(i, j), j * SPACING)
+
+    def get_height(self, i, j):
+        return round(2.0 * math.sin(i * 0.7) * math.cos(j * 0.5), 3)
+
+    def get_road_state(self):
+        rng = self.rng
+        is_double = rng.random() < 0.8
+        state = {
+            'type': 'psdl',
+            'isDouble': is_double,
+            'divider': rng.choice([0, 0, 1, 2, 3]) if is_double else 0,
+            'dividerParam': 0.5,
+            'hasSidewalks': is_double and rng.random() < 0.8,
+            'flatSidewalk': rng.random() < 0.2,
+            'echo': rng.random() < 0.1,
+            'speedLimit': 40,
+            'forwardLanes': rng.randint(0, 2),
+            'backwardLanes': rng.randint(0, 2),
+            'rail_type': rng.choice([0, 0, 0, 1, 2, 3, 4]),
+            'rail_hasLeft': rng.random() < 0.5,
+            'rail_hasRight': rng.random() < 0.5,
+            'rail_height': 1.5,
+        }
+        for i in range(6):
+            state['texture' + str(i)] = 'texture/t' + str(i) + '.tex'
+            state['rail_texture' + str(i)] = 'texture/rail' + str(i) + '.tex'
+        state['textureLOD'] = 'texture/lod.tex'
+        if state['hasSidewalks'] and rng.random() < 0.3:
+            state['propRule'] = copy.deepcopy(rng.choice(self.prop_rules))
+        return state
+
+    def get_prop_rule(self):
+        rng = self.rng
+        def get_elements():
+            return [{
+                'name': rng.choice(['tree', 'lamp', 'bench']),
+                'start': rng.choice([0, 5, 10]),
+                'elemDistance': rng.choice([10, 20]),
+                'maxNumber': 10,
+                'minHorizPos': 0.5,
+                'maxHorizPos': 1.0,
+                'meshes': ['geometry\\' + rng.choice(['tree', 'lamp', 'bench']) + '.pkg'],
+            } for k in range(rng.randint(1, 3))]
+        rule = {}
+        if rng.random() < 0.8:
+            rule['left'] = {'type': 'psdl', 'elements': get_elements()}
+        if rng.random() < 0.8:
+            rule['right'] = {'type': 'psdl', 'elements': get_elements()}
+        if rng.random() < 0.3:
+            rule['middle'] = {'type': 'line', 'elements': get_elements()}
+        return rule
+
+    def get_road(self, road_id, start, end, start_int, end_int):
+        rng = self.rng
+        state = self.get_road_state()
+        vps = get_road_section_layout(state)
+        length = math.sqrt((end[0] - start[0]) ** 2 + (end[2] - start[2]) ** 2)
+        direction = ((end[0] - start[0]) / length, 0.0, (end[2] - start[2]) / length)
+        side = (-direction[2], 0.0, direction[0])
+        p0 = lerp(start, end, INTERSECTION_RADIUS / length)
+        p1 = lerp(start, end, 1 - INTERSECTION_RADIUS / length)
+        num_segments = rng.randint(2, 12)
+        vertices = []
+        for s in range(num_segments):
+            c = lerp(p0, p1, s / (num_segments - 1))
+            for k in range(vps):
+                o = -ROAD_HALF_WIDTH + 2 * ROAD_HALF_WIDTH * k / (vps - 1)
+                vertices.append(vec(c[0] + side[0] * o, c[1] + (0.2 if 0 < k < vps - 1 else 0.0), c[2] + side[2] * o))
+        has_no_caps = state['divider'] <= 1
+        if not has_no_caps:
+            vertices.extend(vertices[:4] + vertices[-4:]) # divider caps
+        instance_state = {
+            'exportToPKG': False,
+            'start_rule': rng.randint(0, 3),
+            'end_rule': rng.randint(0, 3),
+            'rail_continueLeftOnStartIntersection': rng.random() < 0.5,
+            'rail_continueLeftOnEndIntersection': rng.random() < 0.5,
+            'rail_continueRightOnStartIntersection': rng.random() < 0.5,
+            'rail_continueRightOnEndIntersection': rng.random() < 0.5,
+        }
+        road = {
+            'id': road_id,
+            'startIntersectionId': start_int,
+            'endIntersectionId': end_int,
+            'data': {
+                'name': 'Road' + str(road_id),
+                'mesh': {'vertices': vertices},
+                'fields': {
+                    'state': state,
+                    'runtimeState': {'throughIntersection': False},
+                    'instanceState': instance_state,
+                    'vertsPerSection': vps,
+                    'hasStartIntersection': start_int != -1,
+                    'hasEndIntersection': end_int != -1,
+                },
+            },
+        }
+        if 'propRule' in state and 'middle' in state['propRule']:
+            props = []
+            for k in range(rng.randint(1, 4)):
+                props.append({
+                    'meshId': rng.randrange(5),
+                    'position': lerp(p0, p1, rng.random()),
+                    'rotation': (0, 0, 0, 1) if rng.random() < 0.5 else (0.0, 0.7071, 0.0, 0.7071),
+                    'scale': (1, 1, 1),
+                })
+            road['data']['propLines'] = [{'name': 'middle', 'props': props}]
+        return road
+
+    def get_intersection(self, int_id, center, roads):
+        rng = self.rng
+        r = INTERSECTION_RADIUS
+        vertices = []
+        submeshes = []
+        parts = []
+        def add_part(points, indices, material_id, typ):
+            offset = len(vertices)
+            vertices.extend(points)
+            submeshes.append({'indices': [offset + i for i in indices], 'materialId': material_id})
+            parts.append(typ)
+        corners = [vec(center[0] - r, center[1], center[2] - r), vec(center[0] + r, center[1], center[2] - r),
+                   vec(center[0] + r, center[1], center[2] + r), vec(center[0] - r, center[1], center[2] + r)]
+        add_part(corners, [0, 1, 2, 0, 2, 3], 4, 'terrain')
+        if rng.random() < 0.5:
+            cw = [lerp(corners[0], corners[1], t) for t in (0.2, 0.8)] + [lerp(corners[3], corners[2], t) for t in (0.8, 0.2)]
+            add_part(cw, [0, 1, 2, 0, 2, 3], 9, 'crosswalk')
+        for k in range(len(roads)):
+            # sidewalk corners (groups of 4 vertices) and rails between consecutive roads
+            c = corners[k % 4]
+            sw = []
+            for n in range(3):
+                a = lerp(c, center, 0.05 * n)
+                sw.extend([a, vec(a[0], a[1] + 0.2, a[2]), vec(a[0] + 0.5, a[1] + 0.2, a[2]), vec(a[0] + 0.5, a[1], a[2] + 0.5)])
+            indices = []
+            for n in range(2):
+                indices.extend([4 * n, 4 * n + 1, 4 * n + 4, 4 * n + 1, 4 * n + 5, 4 * n + 4])
+            add_part(sw, indices, 1, 'junction_0.' + str(k))
+            if rng.random() < 0.3:
+                add_part(sw[:4], [0, 1, 2], 10, 'junction_1.' + str(k))
+        sort_order = list(range(len(roads)))
+        rng.shuffle(sort_order)
+        state = {
+            'type': 'psdl',
+            'fixSidewalksUV': rng.random() < 0.3,
+            'echo': rng.random() < 0.1,
+            'texture0': 'texture/sw.tex',
+            'texture1': 'texture/sw1.tex',
+            'texture2': 'texture/sw2.tex',
+        }
+        return {
+            'id': int_id,
+            'roads': [road['id'] for road in roads],
+            'roadsThrough': [],
+            'data': {
+                'name': 'Intersection' + str(int_id),
+                'mesh': {'vertices': vertices, 'submeshes': submeshes,
+                         'normals': [vec(0, 1, 0) for v in vertices], 'uvs': [(0.0, 0.0) for v in vertices]},
+                'fields': {
+                    'state': state,
+                    'instanceState': {'exportToPKG': False},
+                    'partsInfo': parts,
+                    'sortOrder': sort_order,
+                },
+            },
+        }
+
+    def get_patch(self, patch_id, perimeter, merge):
+        rng = self.rng
+        state = {
+            'type': 'psdl',
+            'mergeWithConnected': merge,
+            'invisible': rng.random() < 0.05,
+            'exportToPKG': False,
+            'echo': False,
+            'texture': 'texture/grass.tex',
+        }
+        border_meshes = []
+        if rng.random() < 0.2:
+            border_meshes.append({
+                'segment': perimeter[:2],
+                'fields': {'state': {'rail_type': rng.randint(1, 4), 'rail_height': 1.0,
+                                     'rail_texture0': 'texture/rail.tex'}},
+            })
+        return {
+            'perimeterPoints': perimeter,
+            'borderMeshes': border_meshes,
+            'data': {
+                'name': 'TerrainPatch' + str(patch_id),
+                'mesh': get_flat_mesh(perimeter, get_fan_indices(len(perimeter)), 4),
+                'fields': {'state': state},
+            },
+        }
+
+    def get_facade_side(self, p0, p1, height, normal):
+        rng = self.rng
+        num_bounds = rng.randint(1, 4)
+        bottom = [lerp(p0, p1, k / num_bounds) for k in range(num_bounds + 1)]
+        top = [vec(p[0], p[1] + height, p[2]) for p in bottom]
+        quad = {
+            'vertices': [vec(0, 0, 0), vec(4, 0, 0), vec(0, 4, 0), vec(4, 4, 0)],
+            'normals': [vec(0, 0, 1)] * 4,
+            'uvs': [(-rng.randint(1, 3), rng.randint(1, 3))] * 4,
+            'submeshes': [{'indices': [0, 1, 2, 1, 3, 2], 'materialId': rng.choice([5, 6])}],
+        }
+        facades = []
+        for f in range(rng.randint(1, 3)):
+            batch = []
+            for k in range(rng.randint(1, 6)):
+                t = lerp(p0, p1, rng.random())
+                dx = p1[0] - p0[0]
+                dz = p1[2] - p0[2]
+                length = math.sqrt(dx * dx + dz * dz)
+                dx /= length
+                dz /= length
+                # row vector convention: v' = v * M
+                batch.append([dx, 0.0, dz, 0.0,
+                              0.0, 1.0, 0.0, 0.0,
+                              normal[0], 0.0, normal[2], 0.0,
+                              t[0], t[1] + 4.0 * f, t[2], 1.0])
+            facades.append({'instances': {'0': [batch]}})
+        sliver = {
+            'vertices': [top[0], top[-1], vec(top[0][0], top[0][1] + 0.5, top[0][2]), vec(top[-1][0], top[-1][1] + 0.5, top[-1][2])],
+            'uvs': [(0.5, 0.0)] * 4,
+            'submeshes': [{'indices': [0, 1, 2, 1, 3, 2], 'materialId': 8}],
+        }
+        return {
+            'data': {'collider': {'vertices': bottom + top}, 'fields': {'state': {}}},
+            'meshDict': [quad],
+            'facades': facades,
+            'paramMeshes': [sliver],
+        }
+
+    def get_building_line(self, line_id, p0, p1, normal, psdl):
+        rng = self.rng
+        num_buildings = rng.randint(1, 3)
+        buildings = []
+        for b in range(num_buildings):
+            b0 = lerp(p0, p1, b / num_buildings)
+            b1 = lerp(p0, p1, (b + 1) / num_buildings)
+            spline = [lerp(b0, b1, t / 4.0) for t in range(5)]
+            depth = rng.uniform(5.0, 15.0)
+            height = rng.uniform(6.0, 30.0)
+            back = [vec(p[0] + normal[0] * depth, p[1], p[2] + normal[2] * depth) for p in (b0, b1)]
+            roof_pts = [vec(p[0], p[1] + height, p[2]) for p in (b0, b1, back[1], back[0])]
+            buildings.append({
+                'spline': spline,
+                'splineActualNormals': [normal for p in spline],
+                'front': self.get_facade_side(b0, b1, height, normal),
+                'left': None,
+                'right': self.get_facade_side(b1, back[1], height, normal) if rng.random() < 0.5 else None,
+                'back': None,
+                'roof': {'vertices': roof_pts, 'submeshes': [{'indices': get_fan_indices(4), 'materialId': 7}]},
+                'data': {'fields': {'state': {'fixBound': rng.random() < 0.3, 'depth': depth, 'topTexture': 'texture/roof.tex'}}},
+            })
+        points = [p0, p1]
+        mesh = get_flat_mesh([p0, p1, vec(p1[0], p1[1] + 10, p1[2]), vec(p0[0], p0[1] + 10, p0[2])], get_fan_indices(4), 5)
+        return {
+            'linePoints': points,
+            'buildings': buildings if psdl else [],
+            'roof': {'vertices': [vec(p[0], p[1] + 12, p[2]) for p in (p0, p1, p1, p0)], 'submeshes': [{'indices': [0, 1, 2, 0, 2, 3], 'materialId': 7}]} if rng.random() < 0.3 else None,
+            'data': {
+                'name': 'BuildingLine' + str(line_id),
+                'mesh': mesh,
+                'collider': mesh,
+                'fields': {
+                    'state': {'type': 'psdl' if psdl else 'mesh', 'frontOnly': rng.random() < 0.3, 'fixBound': rng.random() < 0.3},
+                    'instanceState': {'exportToPKG': False},
+                },
+            },
+        }
+
+    def get_race(self, name, num_opponents, num_checkpoints):
+        rng = self.rng
+        def get_pos():
+            return {'x': rng.uniform(0, SPACING * self.grid_size), 'y': 0.0, 'z': rng.uniform(0, SPACING * self.grid_size)}
+        def get_model(path):
+            return {'meshPath': path, 'localPosition': get_pos(), 'localRotation': {'x': 0.0, 'y': rng.choice([0.0, 90.0]), 'z': 0.0}}
+        opponents = []
+        for k in range(num_opponents):
+            opponents.append({
+                'carModel': get_model('vehicles/vpbug.pkg'),
+                'waypoints': [{'waypoint': {'localPosition': get_pos()}} for w in range(rng.randint(2, 10))],
+                'speedMultiplier': 1.0,
+                'avoidTraffic': rng.random() < 0.5,
+            })
+        return {
+            'name': name,
+            'trafficDensity': 0.5,
+            'speedLimit': 40.0,
+            'timeOfDay': rng.randint(0, 3),
+            'weather': rng.randint(0, 3),
+            'laps': rng.randint(1, 3),
+            'timeLimit': 300,
+            'pedestriansDensity': 0.5,
+            'policeCars': {'policeCars': [{'carModel': get_model('vehicles/vpcop.pkg')}]},
+            'opponents': {'opponents': opponents},
+            'checkpoints': [{'checkpoint': {'localPosition': get_pos(), 'localRotation': {'x': 0, 'y': 0, 'z': 0}, 'localScale': {'x': 5, 'y': 1, 'z': 1}}}
+                            for c in range(num_checkpoints)],
+        }
+
+    def get_city_properties(self):
+        n = max(1, self.grid_size // 4)
+        return {
+            'cityName': 'Synthetic City',
+            'speedLimit': 40.0,
+            'driveOnLeft': False,
+            'trafficCars': [{'carModel': 'vehicles/vpcar.pkg', 'frequency': 2}, {'carModel': 'vehicles/vpbus.pkg', 'frequency': 1}],
+            'pedModels': [{'goodWeatherPedName': 'pedA', 'badWeatherPedName': 'pedB'}],
+            'roamPoliceCars': {'policeCars': []},
+            'blitzRaces': [self.get_race('Blitz ' + str(k), 2, 5) for k in range(n)],
+            'circuitRaces': [self.get_race('Circuit ' + str(k), 3, 8) for k in range(n)],
+            'checkpointRaces': [self.get_race('Checkpoint ' + str(k), 4, 6) for k in range(n)],
+        }
+
+    def generate(self):
+        rng = self.rng
+        g = self.grid_size
+        data = {
+            'materialDict': get_material_dict(),
+            'meshDict': get_mesh_dict(),
+            'roads': [],
+            'intersections': [],
+            'terrainPatches': [],
+            'buildingLines': [],
+            'meshInstances': [],
+        }
+
+        # roads between neighboring grid nodes
+        node_roads = {}
+        def node_id(i, j):
+            return i * g + j
+        for i in range(g):
+            for j in range(g):
+                for (di, dj) in ((1, 0), (0, 1)):
+                    if i + di < g and j + dj < g:
+                        road = self.get_road(len(data['roads']), self.get_node_pos(i, j), self.get_node_pos(i + di, j + dj),
+                                             node_id(i, j), node_id(i + di, j + dj))
+                        data['roads'].append(road)
+                        node_roads.setdefault(node_id(i, j), []).append(road)
+                        node_roads.setdefault(node_id(i + di, j + dj), []).append(road)
+
+        # intersections on the nodes
+        for i in range(g):
+            for j in range(g):
+                data['intersections'].append(self.get_intersection(node_id(i, j), self.get_node_pos(i, j), node_roads.get(node_id(i, j), [])))
+
+        # terrain patches in the cells (some split in two connected patches), with building lines
+        m = INTERSECTION_RADIUS
+        cells = []
+        for i in range(g - 1):
+            for j in range(g - 1):
+                c00 = self.get_node_pos(i, j)
+                c11 = self.get_node_pos(i + 1, j + 1)
+                x0, x1 = c00[0] + m, c11[0] - m
+                z0, z1 = c00[2] + m, c11[2] - m
+                y = (c00[1] + c11[1]) * 0.5
+                # the smallest cities can't fit a split patch (each cell has at least a patch and a building line)
+                fits_split = count_elements(data) + 2 * ((g - 1) * (g - 1) - len(cells)) + 1 <= self.num_elements
+                if rng.random() < 0.5 and fits_split:
+                    xm = (x0 + x1) * 0.5
+                    rects = [(x0, xm), (xm, x1)]
+                    merge = True
+                else:
+                    rects = [(x0, x1)]
+                    merge = rng.random() < 0.5
+                for (ra, rb) in rects:
+                    perimeter = [vec(ra, y, z0), vec(rb, y, z0), vec(rb, y, z1), vec(ra, y, z1)]
+                    data['terrainPatches'].append(self.get_patch(len(data['terrainPatches']), perimeter, merge))
+                line_z = z0 + 1.0
+                data['buildingLines'].append(self.get_building_line(len(data['buildingLines']), vec(x0 + 2, y, line_z), vec(x1 - 2, y, line_z),
+                                                                    vec(0, 0, 1), rng.random() < 0.9))
+                cells.append((x0, x1, z0, z1, y))
+
+        # traffic lights on some roads
+        for road in data['roads']:
+            if rng.random() < 0.1 and count_elements(data) < self.num_elements:
+                start = road['data']['mesh']['vertices'][0]
+                data['meshInstances'].append({
+                    'name': 'TrafficLight' + str(road['id']),
+                    'reference': {'meshId': 2, 'position': start, 'rotation': (0, 0, 0, 1), 'scale': (1, 1, 1)},
+                    'settings': {'_parameterName': 'startTrafficLight', '_parentObjectId': road['id']},
+                })
+
+        # mesh instances in random cells, up to the number of elements
+        num_meshes = max(0, self.num_elements - count_elements(data))
+        cell_meshes = [0] * len(cells)
+        for k in range(num_meshes):
+            cell_meshes[rng.randrange(len(cells))] += 1
+        for c in range(len(cells)):
+            x0, x1, z0, z1, y = cells[c]
+            for k in range(cell_meshes[c]):
+                data['meshInstances'].append({
+                    'name': 'Mesh' + str(len(data['meshInstances'])).zfill(6),
+                    'reference': {
+                        'meshId': rng.randrange(len(data['meshDict'])),
+                        'position': vec(rng.uniform(x0, x1), y + 1.0, rng.uniform(z0, z1)),
+                        'rotation': (0, 0, 0, 1) if rng.random() < 0.5 else (0.0, 0.3827, 0.0, 0.9239),
+                        'scale': (1, 1, 1),
+                    },
+                    'settings': {'prop': rng.random() < 0.3},
+                })
+
+        data['cityProperties'] = self.get_city_properties()
+        return data
+
+def generate_city(num_elements, seed = 0):
+    return SyntheticCityGenerator(num_elements, seed).generate()
+
+def count_elements(data):
+    return sum(len(data[key]) for key in ('roads', 'intersections', 'terrainPatches', 'buildingLines', 'meshInstances'))
@@ -0,0 +1,126 @@
+import io
+import multiprocessing
+import multiprocessing.connection
+import os
+import sys
+import time
+import traceback
+from contextlib import redirect_stdout
+from profiler import NULL_PROFILER
+
+
+class TaskResult:
+    def __init__(self, name, error = None, output = '', duration = 0, value = None, skipped = False):
+        self.name = name
+        self.error = error # traceback of the exception, None if the task succeeded
+        self.output = output # what the task printed, if it ran in another process
+        self.duration = duration
+        self.value = value # returned by the task, it must be picklable as it's sent back by the forked processes
+        self.skipped = skipped # not run as its inputs didn't change since the last export (watch mode)
+
+def run_task(task, profiler, capture_output):
+    # returns (error, output, duration, value)
+    output = io.StringIO()
+    error = None
+    value = None
+    start = time.perf_counter()
+    try:
+        if capture_output:
+            with redirect_stdout(output):
+                with profiler.stage(task.name):
+                    value = task.function()
+        else:
+            with profiler.stage(task.name):
+                value = task.function()
+    except (Exception, SystemExit):
+        # some exporters exit when the data can't be exported, it's reported with what they printed
+        error = traceback.format_exc()
+    return (error, output.getvalue(), time.perf_counter() - start, value)
+
+def _run_forked_task(task, profiler, conn):
+    error, output, duration, value = run_task(task, profiler, True)
+    conn.send((error, output, duration, value, profiler.take_events()))
+    conn.close()
+
+def print_results(results):
+    for name in results:
+        status = 'unchanged' if results[name].skipped else 'ok' if results[name].error is None else 'FAILED'
+        print('{:<40} {:>9} {:>10.3f} s'.format(name[:40], status, results[name].duration))
+
+class GraphTask:
+    def __init__(self, name, function, deps):
+        self.name = name
+        self.function = function
+        self.deps = deps
+
+class TaskGraph:
+    # tasks with dependencies (names of other tasks), each task runs once all its dependencies succeeded,
+    # the independent ones run at the same time in forked processes, so they must only write files or return their results:
+    # their changes to the state of this process are lost
+    def __init__(self, profiler = None):
+        self.profiler = profiler if profiler is not None else NULL_PROFILER
+        self.tasks = []
+
+    def add_task(self, name, function, deps = []):
+        self.tasks.append(GraphTask(name, function, deps))
+
+    def get_num_workers(self, num_workers = None):
+        if 'fork' not in multiprocessing.get_all_start_methods():
+            return 1 # the exporters can't be shared with the workers
+        if num_workers is None:
+            num_workers = os.cpu_count() or 1
+        return max(1, min(num_workers, len(self.tasks)))
+
+    def report(self, result):
+        if result.output != '':
+            print(result.output, end='' if result.output.endswith('\n') else '\n')
+        if result.error is not None:
+            print('Error in ' + result.name + ':\n' + result.error)
+
+    def run(self, num_workers = None):
+        # returns the TaskResult of each task, by name
+        num_workers = self.get_num_workers(num_workers)
+        results = {}
+        pending = list(self.tasks)
+        running = {} # connection: (task, process)
+        while len(pending) > 0 or len(running) > 0:
+            for task in list(pending):
+                if any(dep in results and results[dep].error is not None for dep in task.deps):
+                    pending.remove(task)
+                    results[task.name] = TaskResult(task.name, 'not run, a dependency failed')
+                    self.report(results[task.name])
+            ready = [task for task in pending if all(dep in results for dep in task.deps)]
+            if num_workers <= 1:
+                if len(ready) == 0:
+                    break
+                task = ready[0]
+                pending.remove(task)
+                results[task.name] = TaskResult(task.name, *run_task(task, self.profiler, False))
+                self.report(results[task.name])
+                continue
+            for task in ready[:(num_workers - len(running))]:
+                pending.remove(task)
+                sys.stdout.flush() # or the forked process would print again what is still buffered
+                parent_conn, child_conn = multiprocessing.Pipe(False)
+                process = multiprocessing.get_context('fork').Process(target=_run_forked_task, args=(task, self.profiler, child_conn))
+                process.start()
+                child_conn.close()
+                running[parent_conn] = (task, process)
+            if len(running) == 0:
+                break
+            for conn in multiprocessing.connection.wait(list(running)):
+                task, process = running.pop(conn)
+                try:
+                    error, output, duration, value, events = conn.recv()
+                    self.profiler.add_events(events)
+                except EOFError:
+                    process.join()
+                    error, output, duration, value = ('the process exited with code ' + str(process.exitcode), '', 0, None)
+                conn.close()
+                process.join()
+                results[task.name] = TaskResult(task.name, error, output, duration, value)
+                self.report(results[task.name])
+        for task in pending:
+            results[task.name] = TaskResult(task.name, 'not run, unknown or circular dependency')
+            self.report(results[task.name])
+        return results
@@ -4,8 +4,9 @@ from pathlib import Path
 
 
 class BinaryWriter:
-    def __init__(self, filepath):
-        self.file = open(filepath, 'wb')
+    def __init__(self, filepath, output = None):
+        # output: OutputFiles to write the file through (only if it changed)
+        self.file = output.open(filepath, 'wb') if output is not None else open(filepath, 'wb')
 
     def write_raw(self, value):
         self.file.write(value)
@@ -69,3 +70,24 @@ def clean_city_path(filename):
 
 def create_folder_if_not_exists(foldername):
     if not os.path.exists(foldername): os.makedirs(foldername)
+
+# Union-find over the integers 0..n-1, the root of each set is its lowest element
+class DisjointSet:
+    def __init__(self, n):
+        self.parent = list(range(n))
+
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:
+            self.parent[i], i = root, self.parent[i]
+        return root
+
+    def union(self, a, b):
+        ra = self.find(a)
+        rb = self.find(b)
+        if ra < rb:
+            self.parent[rb] = ra
+        elif rb < ra:
+            self.parent[ra] = rb
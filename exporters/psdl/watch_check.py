@@ -0,0 +1,46 @@
+import io
+import os
+import sys
+import tempfile
+import traceback
+from contextlib import redirect_stdout
+
+import export
+from synthetic_city import generate_city
+
+# Check of the state kept by the watch mode of export.py between the exports of a city: a good city, then a broken one
+# (failing while its elements are processed), then the good one again, which must export as the first time
+# usage: python watch_check.py <modules path> [number of elements]
+
+def run_export(data, psdl_file, flags, state):
+    # returns the error of the export, None if it succeeded
+    try:
+        with redirect_stdout(io.StringIO()):
+            results = export.export_city(psdl_file.replace('.psdl', '.json'), psdl_file, flags, state=state, data=data)
+    except Exception:
+        return traceback.format_exc()
+    errors = [name + ':\n' + results[name].error for name in results if results[name].error is not None]
+    return '\n'.join(errors) if len(errors) > 0 else None
+
+def main():
+    num_elements = int(sys.argv[2]) if len(sys.argv) > 2 else 500
+    flags = dict(export.get_default_flags(), bin=True) # the BIN only, the check is about the processor
+    broken = generate_city(num_elements)
+    del broken['roads'][0]['data']['fields']
+    steps = [('good city', generate_city(num_elements), True), ('broken city', broken, False), ('good city again', generate_city(num_elements), True)]
+    state = {}
+    failed = 0
+    with tempfile.TemporaryDirectory() as folder:
+        psdl_file = os.path.join(folder, 'city.psdl')
+        for (name, data, should_succeed) in steps:
+            error = run_export(data, psdl_file, flags, state)
+            ok = (error is None) == should_succeed
+            print('{:<20} {:>8} {}'.format(name, 'ok' if ok else 'FAILED', '' if should_succeed else '(expected to fail)'))
+            if not ok:
+                failed += 1
+                if error is not None:
+                    print(error)
+    return 1 if failed > 0 else 0
+
+if __name__ == '__main__':
+    sys.exit(main())